@@ -1,14 +1,63 @@
 # --------------------------------导包-------------------------------
 import csv
-from datetime import datetime
+import functools
+import gzip
+import hashlib
+import http.cookiejar
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from types import SimpleNamespace
+from typing import Optional
 import io
+import itertools
+import json
+import mimetypes
 import os
+import pickle
+import posixpath
+import random
+import re
+import secrets
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
 from sqlalchemy.sql import func
-from flask import Flask, render_template, request, redirect, url_for, session, flash, make_response
+import click
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, jsonify, g, has_request_context, Response, stream_with_context, before_render_template, template_rendered, send_file, send_from_directory
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import BadSignature
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 from sqlalchemy.orm import joinedload,Mapped,mapped_column,relationship
-from sqlalchemy import Integer, String, Float, DateTime, ForeignKey
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import TypeDecorator, event, Engine, Integer, BigInteger, String, Date, DateTime, Text, ForeignKey, Index, Table, Column, select, text, table, column, literal_column, and_, case, true, update, delete, insert, tuple_, inspect, literal, bindparam
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert, array as postgresql_array
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.datastructures import CallbackDict
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+try:  # 可选依赖：没装时不生成缩放/WebP 图片和 brotli 压缩版本，见“静态资源”
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # ------------------------------------------------------------------
 
@@ -16,66 +65,188 @@ from werkzeug.security import generate_password_hash, check_password_hash
 app=Flask(__name__) # 作为主程序运行
 app.secret_key = os.environ.get('SECRET_KEY','dev_key')
 
+# 前面有几层反向代理（如 Render 的负载均衡）；设置后 request.remote_addr 取 X-Forwarded-For 里的真实客户端地址
+PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+if PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT, x_proto=PROXY_COUNT)
+
 raw_db_url = os.environ.get('DATABASE_URL')# Get and fix DATABASE_URL for PostgreSQL on Render
 if raw_db_url and raw_db_url.startswith('postgres://'):
     raw_db_url=raw_db_url.replace('postgres://','postgresql://',1)
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = raw_db_url
+
+# 运行方式由 gunicorn.conf.py 按 WEB_MODE 选择：sync 每个进程同时处理一个请求，threads 每个进程 WEB_THREADS 个线程
+WEB_MODE = os.environ.get('WEB_MODE', 'sync')
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+# 连接池按每个进程的并发数显式设置：默认每个请求线程一个连接，另留一个给后台任务线程
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', (WEB_THREADS if WEB_MODE == 'threads' else 1) + 1))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 2))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))     # 取连接最多等待秒数，超时报错而不是一直挂起
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))     # 连接用满该秒数后重建，避开服务端空闲断开
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'True') == 'True'  # 取连接时先探活，数据库重启后自动换掉坏连接
+
+engine_options = {'pool_pre_ping': DB_POOL_PRE_PING, 'pool_recycle': DB_POOL_RECYCLE}
+if raw_db_url and not raw_db_url.startswith('sqlite'):  # SQLite 连接很便宜，沿用默认连接池
+    engine_options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
 app.config['DEBUG'] = os.environ.get('FLASK_DEBUG','False') == 'True'
 
-db = SQLAlchemy(app)
+# 只读副本，多个用逗号分隔；只读页面的查询轮流发往这些库，见“读写分离”
+REPLICA_URLS = [url.strip().replace('postgres://', 'postgresql://', 1)
+                for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_KEYS = [f'replica{i}' for i in range(len(REPLICA_URLS))]
+app.config['SQLALCHEMY_BINDS'] = dict(zip(REPLICA_KEYS, REPLICA_URLS))
+
+class RoutingSession(FlaskSession):
+    """只读请求里的查询发往选中的副本（g.read_replica），写语句和 flush 始终走主库"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not isinstance(clause, UpdateBase) \
+                and has_request_context() and g.get('read_replica') is not None:
+            return g.read_replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 # ------------------------------------------------------------------
 
 # --------------------------定义模型----------------------------------
+CENT = Decimal('0.01')
+
+class Money(TypeDecorator):
+    """金额：数据库里存整数分，Python 里是两位小数的 Decimal，数据库里求和没有浮点误差"""
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int((Decimal(str(value)) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(round(value)).scaleb(-2)  # 迁移前的 SQLite 列按浮点存整数分，先取整
+
+MAX_MONEY = Decimal(2 ** 63 - 1).scaleb(-2)  # BigInteger 能存下的最大分数
+
+def parse_money(value):
+    """把表单或 CSV 里的金额文本转成两位小数的 Decimal，格式不对或超出范围时一律抛出 ValueError"""
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f'{value} 不是有效的金额')
+    if not amount.is_finite():
+        raise ValueError(f'{value} 不是有效的金额')
+    if abs(amount) > MAX_MONEY:
+        raise ValueError(f'{value} 超出金额范围')
+    try:
+        return amount.quantize(CENT, ROUND_HALF_UP)
+    except InvalidOperation:  # 结果位数超过当前 Decimal 精度时 quantize 会抛这个
+        raise ValueError(f'{value} 不是有效的金额')
+
 # 店家
 class Product(db.Model):  # 商品表
     __tablename__ = 'products'
+    __table_args__ = (
+        Index('uq_products_name_category', 'name', 'category', unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(100), nullable=False)
-    price: Mapped[float] = mapped_column(Float, nullable=False)
-    stock: Mapped[int] = mapped_column(Integer, nullable=False)
+    price: Mapped[Decimal] = mapped_column(Money, nullable=False)
+    stock: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
     category: Mapped[str] = mapped_column(String(100), nullable=False)
     created_at: Mapped[datetime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now()
+        DateTime(timezone=True), server_default=func.now(), index=True
     )
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), default=func.now(),
+                                                           onupdate=func.now())
+    version: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('1'),
+                                         onupdate=text('version + 1'))  # 每次 UPDATE 加一
 
-    # 反向关系
+    # 反向关系（默认禁止隐式加载，需要时在查询里显式指定加载方式）
     order_items: Mapped[list["OrderItem"]] = relationship(
-        back_populates="product", lazy="selectin"
+        back_populates="product", lazy="raise", passive_deletes=True
     )
 
 
 class Order(db.Model):  # 订单表
     __tablename__ = 'orders'
+    __table_args__ = {'sqlite_autoincrement': True}  # SQLite 默认会复用已删除的最大编号，会与归档表里的订单撞号
 
     id: Mapped[int] = mapped_column(primary_key=True)
     customer: Mapped[str] = mapped_column(String(100), nullable=False)
     phone: Mapped[str] = mapped_column(String(100), nullable=False)
     address: Mapped[str] = mapped_column(String(100), nullable=False)
     created_at: Mapped[datetime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now()
+        DateTime(timezone=True), server_default=func.now(), index=True
     )
-    status: Mapped[str] = mapped_column(String(50), default="待处理")
-
-    # 反向关系
+    status: Mapped[str] = mapped_column(String(50), default="待处理", index=True)
+    total: Mapped[Decimal] = mapped_column(Money, nullable=False, server_default=text('0'))  # 下单时按单价算好的订单金额
+    customer_id: Mapped[Optional[int]] = mapped_column(ForeignKey("customers.id"), index=True)  # 下单账号，旧订单为空
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), default=func.now(),
+                                                           onupdate=func.now())
+    version: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('1'),
+                                         onupdate=text('version + 1'))
+
+    # 反向关系（默认禁止隐式加载，需要时在查询里显式指定加载方式）
     items: Mapped[list["OrderItem"]] = relationship(
-        back_populates="order", lazy="selectin"
+        back_populates="order", lazy="raise", cascade="all, delete-orphan"
     )
 
 
 class OrderItem(db.Model):  # 订单项表（连接订单和商品）
     __tablename__ = 'order_items'
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    order_id: Mapped[int] = mapped_column(ForeignKey("orders.id"), nullable=False)
-    product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), nullable=False)
+    order_id: Mapped[int] = mapped_column(ForeignKey("orders.id"), nullable=False, index=True)
+    product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), nullable=False, index=True)
     quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    unit_price: Mapped[Optional[Decimal]] = mapped_column(Money)  # 下单时的单价，旧数据为空
+
+    # 双向关系（默认禁止隐式加载，需要时在查询里显式指定加载方式）
+    product: Mapped["Product"] = relationship(back_populates="order_items", lazy="raise")
+    order: Mapped["Order"] = relationship(back_populates="items", lazy="raise")
 
-    # 双向关系
-    product: Mapped["Product"] = relationship(back_populates="order_items", lazy="joined")
-    order: Mapped["Order"] = relationship(back_populates="items")
+
+# 归档表：已处理且超过 ARCHIVE_AFTER_DAYS 天的订单由后台任务从 orders/order_items 移到这里，保留原订单号
+class ArchivedOrder(db.Model):  # 归档订单表
+    __tablename__ = 'archived_orders'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    customer: Mapped[str] = mapped_column(String(100), nullable=False)
+    phone: Mapped[str] = mapped_column(String(100), nullable=False)
+    address: Mapped[str] = mapped_column(String(100), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
+    status: Mapped[str] = mapped_column(String(50), nullable=False)
+    total: Mapped[Decimal] = mapped_column(Money, nullable=False)
+    customer_id: Mapped[Optional[int]] = mapped_column(Integer, index=True)
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))  # 与版本号一起从热表原样复制
+    version: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('1'))
+    archived_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+    items: Mapped[list["ArchivedOrderItem"]] = relationship(lazy="raise")
+
+
+class ArchivedOrderItem(db.Model):  # 归档订单项表，商品名称和分类按归档时保存，商品删除后仍可查看
+    __tablename__ = 'archived_order_items'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    order_id: Mapped[int] = mapped_column(ForeignKey("archived_orders.id"), nullable=False, index=True)
+    product_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    product_name: Mapped[str] = mapped_column(String(100), nullable=False)
+    product_category: Mapped[str] = mapped_column(String(100), nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    unit_price: Mapped[Decimal] = mapped_column(Money, nullable=False)
+
+    @property
+    def product(self):
+        """与 OrderItem.product 同样的用法，订单模板不用区分"""
+        return SimpleNamespace(id=self.product_id, name=self.product_name,
+                               category=self.product_category, price=self.unit_price)
 
 
 class Purchase(db.Model):  # 进货表
@@ -86,13 +257,18 @@ class Purchase(db.Model):  # 进货表
     phone: Mapped[str] = mapped_column(String(100), nullable=False)
     address: Mapped[str] = mapped_column(String(100), nullable=False)
     created_at: Mapped[datetime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now()
+        DateTime(timezone=True), server_default=func.now(), index=True
     )
     product_name: Mapped[str] = mapped_column(String(100), nullable=False)
-    product_price: Mapped[float] = mapped_column(Float, nullable=False)
+    product_price: Mapped[Decimal] = mapped_column(Money, nullable=False)
     product_category: Mapped[str] = mapped_column(String(50), nullable=False)
     product_quantity: Mapped[int] = mapped_column(Integer, nullable=False)
-    status: Mapped[str] = mapped_column(String(50), default="待处理")
+    status: Mapped[str] = mapped_column(String(50), default="待处理", index=True)
+    received_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))  # 入库时间，非空表示库存已增加
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), default=func.now(),
+                                                           onupdate=func.now())
+    version: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('1'),
+                                         onupdate=text('version + 1'))
 
 
 class Customer(db.Model):  # 顾客账号密码表
@@ -102,17 +278,3021 @@ class Customer(db.Model):  # 顾客账号密码表
     username: Mapped[str] = mapped_column(String(100), nullable=False, unique=True)
     password_hash: Mapped[str] = mapped_column(String(128), nullable=False)
 
+    # 哈希计算放到有上限的线程/进程池里执行，见“密码哈希工具”
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+
+# 统计汇总表，由下单/删单/进货入库时增量维护，flask backfill-analytics 可全量重建
+class DailySales(db.Model):  # 每日各分类销售额
+    __tablename__ = 'daily_sales'
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    category: Mapped[str] = mapped_column(String(100), primary_key=True)
+    revenue: Mapped[Decimal] = mapped_column(Money, nullable=False, default=0)
+    units: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class ProductSales(db.Model):  # 各商品累计销量
+    __tablename__ = 'product_sales'
+
+    product_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    units: Mapped[int] = mapped_column(Integer, nullable=False, default=0, index=True)
+    revenue: Mapped[Decimal] = mapped_column(Money, nullable=False, default=0)
+
+
+class DailyPurchases(db.Model):  # 每日各分类进货额
+    __tablename__ = 'daily_purchases'
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    category: Mapped[str] = mapped_column(String(100), primary_key=True)
+    cost: Mapped[Decimal] = mapped_column(Money, nullable=False, default=0)
+    units: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+class Job(db.Model):  # 后台任务表
+    __tablename__ = 'jobs'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(String(50), nullable=False)
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+    status: Mapped[str] = mapped_column(String(20), default="queued", index=True)  # queued / running / done / failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[Optional[str]] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+
+
+class ChangeLog(db.Model):  # 变更记录表，商品/订单/进货单每次写入都记一行，编号即增量导出的断点
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        Index('ix_change_log_table_id', 'table_name', 'id'),
+        Index('ix_change_log_row', 'table_name', 'row_id'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    table_name: Mapped[str] = mapped_column(String(50), nullable=False)
+    row_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    op: Mapped[str] = mapped_column(String(10), nullable=False)  # insert / update / upsert / delete / archive
+    # 提交前才写入（见 _write_changes），取的是应用当前时间，接近提交时间
+    changed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False,
+                                                 default=lambda: datetime.now(timezone.utc))
+# -------------------------------------------------------------------
+
+# ---------------------------密码哈希工具------------------------------
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD')  # 如 scrypt:32768:8:1、pbkdf2:sha256:600000，不设置用 werkzeug 默认
+PASSWORD_HASH_POOL = os.environ.get('PASSWORD_HASH_POOL', 'thread')  # thread / process
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', PASSWORD_HASH_WORKERS * 4))  # 同时排队的上限
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 5))
+
+class PasswordHashBusy(Exception):
+    """哈希线程池排满，登录/注册请求直接拒绝，避免拖垮其他页面"""
+
+_hash_pool = None
+_hash_prefix = None
+_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE)
+
+def _get_hash_pool():
+    # gunicorn 在导入后 fork 出 worker，进程池/线程池要在 worker 里首次使用时再创建
+    global _hash_pool
+    if _hash_pool is None:
+        if PASSWORD_HASH_POOL == 'process':
+            _hash_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+        else:
+            _hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='pwhash')
+    return _hash_pool
+
+def _run_hash(fn, *args):
+    # 排队已满时立即拒绝，不占着 worker 等空位；空位在任务真正结束时才归还，
+    # 等待超时的任务仍在池里运行，提前归还会让排队数超过上限
+    if not _hash_slots.acquire(blocking=False):
+        raise PasswordHashBusy()
+    try:
+        future = _get_hash_pool().submit(fn, *args)
+    except BaseException:
+        _hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hash_slots.release())
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()  # 还没开始算的直接取消，已在运行的算完后由回调归还空位
+        raise PasswordHashBusy()
+
+def hash_password(password):
+    if PASSWORD_HASH_METHOD:
+        return _run_hash(generate_password_hash, password, PASSWORD_HASH_METHOD)
+    return _run_hash(generate_password_hash, password)
+
+def verify_password(password_hash, password):
+    return _run_hash(check_password_hash, password_hash, password)
+
+def password_needs_rehash(password_hash):
+    """已存哈希的算法参数和当前配置不一致时返回 True"""
+    global _hash_prefix
+    if _hash_prefix is None:
+        _hash_prefix = hash_password('probe').split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != _hash_prefix
+
+@app.cli.command('bench-login')
+@click.option('--threads', default=8, help='并发线程数')
+@click.option('--requests', 'total', default=200, help='登录请求总数')
+@click.option('--admission/--no-admission', 'keep_admission', default=False, help='保留限流（默认关闭，只测登录本身）')
+def bench_login(threads, total, keep_admission):
+    """多线程并发调用 /customer_login，输出吞吐量和延迟分位数"""
+    global admission_backend
+    if not keep_admission:
+        admission_backend = None
+    username = f'bench_{int(time.time())}'
+    customer = Customer(username=username)
+    customer.set_password('bench-password')
+    db.session.add(customer)
+    db.session.commit()
+
+    latencies = []
+    statuses = []
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with counter_lock:
+                if next(counter, None) is None:
+                    return
+            started = time.perf_counter()
+            response = client.post('/customer_login', data={'username': username, 'password': 'bench-password'})
+            latencies.append(time.perf_counter() - started)
+            statuses.append(response.headers.get('Location', ''))
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    Customer.query.filter_by(username=username).delete()
+    db.session.commit()
+
+    latencies.sort()
+    ok = sum(1 for location in statuses if location.endswith('/customer_dashboard'))
+    print(f'哈希方式 {PASSWORD_HASH_METHOD or "werkzeug 默认"}，{PASSWORD_HASH_POOL} 池 {PASSWORD_HASH_WORKERS} 个 worker')
+    print(f'{threads} 线程 {total} 次登录，成功 {ok} 次，耗时 {elapsed:.2f}s，吞吐量 {total / elapsed:.1f} 次/秒')
+    print(f'p50 {latencies[len(latencies) // 2] * 1000:.1f}ms，p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms')
+# -------------------------------------------------------------------
+
+# ---------------------------流式导出工具------------------------------
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))  # 每批从数据库读取的行数
+
+def stream_csv(headers, *stmts, batch_size=EXPORT_BATCH_SIZE):
+    """按批读取查询结果，每批拼成一段 CSV 文本返回，内存占用与总行数无关；多条语句的结果依次写出"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(headers)
+    yield output.getvalue()
+
+    for stmt in stmts:
+        result = db.session.execute(stmt.execution_options(yield_per=batch_size))
+        for rows in result.partitions():
+            output.seek(0)
+            output.truncate(0)
+            writer.writerows(rows)
+            yield output.getvalue()
+
+def stream_ndjson(keys, *stmts, batch_size=EXPORT_BATCH_SIZE):
+    """与 stream_csv 相同的分批读取，每行输出一个以 keys 为键的 JSON 对象"""
+    for stmt in stmts:
+        result = db.session.execute(stmt.execution_options(yield_per=batch_size))
+        for rows in result.partitions():
+            yield ''.join(json.dumps(dict(zip(keys, row)), ensure_ascii=False, separators=(',', ':'),
+                                     default=_json_value) + '\n' for row in rows)
+
+def gzip_stream(chunks, level=6):
+    """把文本片段流压缩成 gzip 字节流"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+# -------------------------------------------------------------------
+
+# ---------------------------商品搜索工具------------------------------
+SEARCH_MIN_NGRAM = 3   # trigram 索引能覆盖的最短关键词长度
+SEARCH_BIGRAM = 2      # 两个字的关键词（苹果、香蕉这类最常见的中文搜索）走 bigram 索引，单字退回 LIKE
+SEARCH_MAX_TERMS = 5   # 一次搜索最多使用的关键词个数
+SEARCH_BIGRAM_POSITIONS = 255  # SQLite 触发器按位置切分商品名称，超出这个长度的部分不建 bigram
+_search_backend = None  # 首次搜索时探测：pg_trgm / fts5 / like
+_search_bigrams = None  # 同上，bigram 索引是否存在
+
+products_fts = table('products_fts', column('rowid'), column('name'))
+product_bigrams = table('product_bigrams', column('gram'), column('product_id'))
+
+def create_search_index(conn):
+    """建立商品名称的搜索索引：PostgreSQL 用 pg_trgm 的 GIN 索引，SQLite 用 FTS5 trigram 虚拟表。
+    数据库不支持时跳过，搜索退回 LIKE"""
+    try:
+        with conn.begin_nested():
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+                conn.execute(text('CREATE INDEX IF NOT EXISTS ix_products_name_trgm '
+                                  'ON products USING gin (name gin_trgm_ops)'))
+
+            elif conn.dialect.name == 'sqlite':
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+                )).first()
+                if not exists:
+                    conn.execute(text("CREATE VIRTUAL TABLE products_fts USING fts5("
+                                      "name, content='products', content_rowid='id', tokenize='trigram')"))
+                    conn.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+                # 触发器保证商品表的增删改同步到全文索引
+                conn.execute(text("""
+                    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+                        INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name);
+                    END"""))
+                conn.execute(text("""
+                    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+                        INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                    END"""))
+                conn.execute(text("""
+                    CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name ON products BEGIN
+                        INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                        INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name);
+                    END"""))
+
+    except Exception as e:
+        app.logger.exception(e)
+
+def create_search_bigrams(conn):
+    """trigram 索引对两个字的关键词不起作用，另建商品名称的 bigram 索引：
+    PostgreSQL 对名称切出的二字数组建 GIN 表达式索引；SQLite 用一张 (二字, 商品编号) 表，由触发器维护。
+    SQLite 的触发器里不能用 WITH，借一张位置表 search_positions 逐位切分"""
+    try:
+        with conn.begin_nested():
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text("""
+                    CREATE OR REPLACE FUNCTION product_name_bigrams(name text) RETURNS text[]
+                    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+                        SELECT coalesce(array_agg(DISTINCT lower(substr(name, i, 2))), '{}')
+                        FROM generate_series(1, char_length(name) - 1) AS i
+                    $$"""))
+                conn.execute(text('CREATE INDEX IF NOT EXISTS ix_products_name_bigram '
+                                  'ON products USING gin (product_name_bigrams(name))'))
+
+            elif conn.dialect.name == 'sqlite':
+                conn.execute(text('CREATE TABLE IF NOT EXISTS search_positions (n INTEGER PRIMARY KEY)'))
+                conn.execute(text('INSERT OR IGNORE INTO search_positions (n) VALUES (:n)'),
+                             [{'n': n} for n in range(1, SEARCH_BIGRAM_POSITIONS + 1)])
+                conn.execute(text('CREATE TABLE IF NOT EXISTS product_bigrams ('
+                                  'gram TEXT NOT NULL, product_id INTEGER NOT NULL, '
+                                  'PRIMARY KEY (gram, product_id)) WITHOUT ROWID'))
+                conn.execute(text('CREATE INDEX IF NOT EXISTS ix_product_bigrams_product '
+                                  'ON product_bigrams (product_id)'))
+                split = ('INSERT OR IGNORE INTO product_bigrams (gram, product_id) '
+                         'SELECT lower(substr({row}.name, n, 2)), {row}.id FROM search_positions '
+                         'WHERE n < length({row}.name)')
+                conn.execute(text('INSERT OR IGNORE INTO product_bigrams (gram, product_id) '
+                                  'SELECT lower(substr(name, n, 2)), id FROM products '
+                                  'JOIN search_positions ON n < length(name)'))
+                conn.execute(text(f"""
+                    CREATE TRIGGER IF NOT EXISTS product_bigrams_ai AFTER INSERT ON products BEGIN
+                        {split.format(row='new')};
+                    END"""))
+                conn.execute(text("""
+                    CREATE TRIGGER IF NOT EXISTS product_bigrams_ad AFTER DELETE ON products BEGIN
+                        DELETE FROM product_bigrams WHERE product_id = old.id;
+                    END"""))
+                conn.execute(text(f"""
+                    CREATE TRIGGER IF NOT EXISTS product_bigrams_au AFTER UPDATE OF name ON products BEGIN
+                        DELETE FROM product_bigrams WHERE product_id = old.id;
+                        {split.format(row='new')};
+                    END"""))
+
+    except Exception as e:
+        app.logger.exception(e)
+
+def get_search_backend():
+    """探测迁移建好的搜索索引（trigram 和 bigram 一条语句查完），结果在进程内缓存"""
+    global _search_backend, _search_bigrams
+    if _search_backend is None:
+        backend = 'like'
+        found = set()
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            found = set(db.session.execute(text(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE indexname IN ('ix_products_name_trgm', 'ix_products_name_bigram')")).scalars())
+            if 'ix_products_name_trgm' in found:
+                backend = 'pg_trgm'
+        elif dialect == 'sqlite':
+            found = set(db.session.execute(text(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'table' AND name IN ('products_fts', 'product_bigrams')")).scalars())
+            if 'products_fts' in found:
+                backend = 'fts5'
+        _search_bigrams = bool(found & {'ix_products_name_bigram', 'product_bigrams'})
+        _search_backend = backend
+    return _search_backend
+
+def has_search_bigrams():
+    get_search_backend()
+    return _search_bigrams
+
+def search_terms(search):
+    """按空白切分关键词；中文按字符建 trigram/bigram，不依赖分词，词与词之间是 AND 关系"""
+    return [term for term in search.split() if term][:SEARCH_MAX_TERMS]
+
+def product_search_clause(search):
+    """返回匹配商品名称的过滤条件，能走索引的关键词走索引"""
+    conditions = []
+    fts_terms = []
+    backend = get_search_backend()
+    for term in search_terms(search):
+        if backend == 'fts5' and len(term) >= SEARCH_MIN_NGRAM:
+            fts_terms.append('"' + term.replace('"', '""') + '"')
+        elif len(term) == SEARCH_BIGRAM and has_search_bigrams():
+            # 两个字的词正好是一个 bigram，查到即命中，不用再 LIKE 复核
+            if db.engine.dialect.name == 'postgresql':
+                conditions.append(func.product_name_bigrams(Product.name).op('@>')(
+                    postgresql_array([func.lower(term)])))
+            else:
+                conditions.append(Product.id.in_(
+                    select(product_bigrams.c.product_id).where(product_bigrams.c.gram == func.lower(term))))
+        else:
+            # pg_trgm 的 GIN 索引本身就能加速 ILIKE '%term%'
+            conditions.append(Product.name.icontains(term, autoescape=True))
+
+    if fts_terms:
+        matched = (select(products_fts.c.rowid)
+                   .where(literal_column('products_fts').op('MATCH')(' AND '.join(fts_terms))))
+        conditions.append(Product.id.in_(matched))
+
+    return and_(*conditions) if conditions else true()
+
+def product_search_rank(search):
+    """商品搜索结果的相关度排序：完全匹配 > 前缀匹配 > 名称越短越靠前"""
+    terms = search_terms(search)
+    if not terms:
+        return []
+    if get_search_backend() == 'pg_trgm':
+        return [func.similarity(Product.name, ' '.join(terms)).desc()]
+    first = terms[0]
+    return [
+        case((Product.name == first, 0),
+             (Product.name.istartswith(first, autoescape=True), 1),
+             else_=2),
+        func.length(Product.name),
+    ]
+# -------------------------------------------------------------------
+
+# ---------------------------游标分页工具------------------------------
+PER_PAGE = 10
+COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL', 60))  # 总数缓存秒数
+COUNT_ESTIMATE_MIN = 100000  # PostgreSQL 大表超过该行数时直接用统计信息估算总数
+_count_cache = {}
+
+def cached_count(key, query, model=None):
+    """返回查询的总行数，同一 key 在 COUNT_CACHE_TTL 秒内只数一次；传入 model 表示无过滤条件，可用估算值"""
+    now = time.monotonic()
+    hit = _count_cache.get(key)
+    if hit and hit[1] > now:
+        return hit[0]
+
+    total = None
+    if model is not None and db.engine.dialect.name == 'postgresql':
+        estimate = db.session.execute(
+            text('SELECT reltuples::bigint FROM pg_class WHERE relname = :name'),
+            {'name': model.__tablename__}
+        ).scalar()
+        if estimate and estimate >= COUNT_ESTIMATE_MIN:
+            total = estimate
+    if total is None:
+        total = query.order_by(None).count()
+
+    if len(_count_cache) > 1024:
+        _count_cache.clear()
+    _count_cache[key] = (total, now + COUNT_CACHE_TTL)
+    return total
+
+class KeysetPagination:
+    """游标分页结果，属性与 Flask-SQLAlchemy 的 Pagination 保持一致，模板无需区分"""
+
+    def __init__(self, items, page, per_page, total, has_prev, has_next, key):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.first_id = getattr(items[0], key) if items else None
+        self.last_id = getattr(items[-1], key) if items else None
+
+        # 总数可能来自缓存，用本页的实际情况校正总页数
+        pages = max(-(-total // per_page), 1)
+        if has_next:
+            pages = max(pages, page + 1)
+        else:
+            pages = page
+        self.total = total
+        self.pages = pages
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    def iter_pages(self, *, left_edge=2, left_current=2, right_current=4, right_edge=2):
+        pages_end = self.pages + 1
+        if pages_end == 1:
+            return
+
+        left_end = min(1 + left_edge, pages_end)
+        yield from range(1, left_end)
+        if left_end == pages_end:
+            return
+
+        mid_start = max(left_end, self.page - left_current)
+        mid_end = min(self.page + right_current + 1, pages_end)
+        if mid_start - left_end > 0:
+            yield None
+        yield from range(mid_start, mid_end)
+        if mid_end == pages_end:
+            return
+
+        right_start = max(mid_end, pages_end - right_edge)
+        if right_start - mid_end > 0:
+            yield None
+        yield from range(right_start, pages_end)
+
+def keyset_paginate(query, column, search='', per_page=PER_PAGE, rank=None, scope=None):
+    """按 column 做游标分页：带 after/before 参数时走索引定位，只有直接跳页才用 OFFSET。
+    传入 rank 时按相关度排序，搜索结果集较小，直接按页码分页；
+    scope 表示查询只包含部分数据（如某个顾客的订单），总数按 scope 分别缓存"""
+    page = max(request.args.get('page', 1, type=int), 1)
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+
+    if rank:
+        rows = query.order_by(*rank, column).offset((page - 1) * per_page).limit(per_page + 1).all()
+        has_prev = page > 1
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+    elif before is not None:
+        rows = query.filter(column < before).order_by(column.desc()).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        has_next = True
+        if not has_prev:
+            page = 1
+    elif after is not None:
+        rows = query.filter(column > after).order_by(column).limit(per_page + 1).all()
+        has_prev = True
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        page = max(page, 2)
+    else:
+        rows = query.order_by(column).offset((page - 1) * per_page).limit(per_page + 1).all()
+        has_prev = page > 1
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+
+    model = column.class_
+    unfiltered = not search and scope is None
+    total = cached_count((model.__tablename__, search, scope), query, model if unfiltered else None)
+    return KeysetPagination(items, page, per_page, total, has_prev, has_next, column.key)
+# -------------------------------------------------------------------
+
+# ---------------------------商品目录缓存------------------------------
+CATALOG_CACHE = os.environ.get('CATALOG_CACHE', 'local')  # local / off / sqlite:///共享缓存文件路径
+CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', 60))
+CATALOG_CACHE_SIZE = int(os.environ.get('CATALOG_CACHE_SIZE', 1024))
+
+cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+class LocalCache:
+    """进程内 LRU 缓存，条目带过期时间和标签，按标签精确失效"""
+
+    def __init__(self, max_entries=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, 过期时间, 标签)
+        self._tags = {}                # 标签 -> key 集合
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+class SqliteCache:
+    """同一台机器上多个 worker 共享的缓存，用本地 SQLite 文件代替独立的缓存服务；
+    serializer 需提供 dumps/loads，默认 pickle，会话等只存 JSON 数据的改用 JSON"""
+
+    def __init__(self, path, ttl=CATALOG_CACHE_TTL, serializer=pickle):
+        self.path = path
+        self.ttl = ttl
+        self.serializer = serializer
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_tags (tag TEXT, key TEXT, PRIMARY KEY (tag, key))')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_tags_key ON cache_tags (key)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value, expires FROM cache_entries WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        try:
+            return self.serializer.loads(row[0])
+        except ValueError:  # 换了序列化格式后的旧条目，当作未命中
+            return None
+
+    def set(self, key, value, tags=()):
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?)',
+                         (key, self.serializer.dumps(value), now + self.ttl))
+            conn.execute('DELETE FROM cache_tags WHERE key = ?', (key,))
+            conn.executemany('INSERT OR IGNORE INTO cache_tags VALUES (?, ?)', [(tag, key) for tag in tags])
+            if random.random() < 0.01:  # 偶尔顺手清理过期条目
+                conn.execute('DELETE FROM cache_tags WHERE key IN (SELECT key FROM cache_entries WHERE expires < ?)', (now,))
+                conn.execute('DELETE FROM cache_entries WHERE expires < ?', (now,))
+
+    def delete(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+            conn.execute('DELETE FROM cache_tags WHERE key = ?', (key,))
+
+    def invalidate(self, tags):
+        tags = list(tags)
+        if not tags:
+            return
+        marks = ','.join('?' * len(tags))
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(f'DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_tags WHERE tag IN ({marks}))', tags)
+            conn.execute(f'DELETE FROM cache_tags WHERE key NOT IN (SELECT key FROM cache_entries)')
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM cache_entries')
+            conn.execute('DELETE FROM cache_tags')
+
+def make_cache(url, max_entries=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL, serializer=pickle):
+    if url == 'off':
+        return None
+    if url.startswith('sqlite:///'):
+        return SqliteCache(url[len('sqlite:///'):], ttl=ttl, serializer=serializer)
+    return LocalCache(max_entries=max_entries, ttl=ttl)
+
+catalog_cache = make_cache(CATALOG_CACHE)
+
+def invalidate_catalog(product_ids=None):
+    """商品增删时让整个目录失效；只有库存变化时只让包含这些商品的页面失效"""
+    if product_ids is None:
+        _count_cache.clear()
+    if catalog_cache is None:
+        return
+    tags = ['catalog'] if product_ids is None else [f'product:{pid}' for pid in product_ids]
+    catalog_cache.invalidate(tags)
+    cache_stats['invalidations'] += 1
+
+def invalidate_orders(order_ids=(), customer_id=None):
+    """订单新增、改状态或删除后，让店家订单列表和包含这些订单的接口结果失效"""
+    if catalog_cache is None:
+        return
+    tags = ['orders'] + [f'order:{oid}' for oid in order_ids]
+    if customer_id is not None:
+        tags.append(f'orders:customer:{customer_id}')
+    catalog_cache.invalidate(tags)
+    cache_stats['invalidations'] += 1
+
+def product_row(p):
+    """把商品转成可缓存的字典，模板里 product.name 之类的写法不用改"""
+    return {'id': p.id, 'name': p.name, 'price': p.price, 'stock': p.stock,
+            'category': p.category, 'created_at': p.created_at, 'version': p.version}
+
+def catalog_page(search):
+    """顾客端商品目录的一页：先查缓存，未命中再查数据库并写入缓存"""
+    key = 'catalog:' + json.dumps([search, request.args.get('page', 1, type=int),
+                                   request.args.get('after', type=int),
+                                   request.args.get('before', type=int)], ensure_ascii=False)
+    if catalog_cache is not None:
+        pagination = catalog_cache.get(key)
+        if pagination is not None:
+            cache_stats['hits'] += 1
+            return pagination
+        cache_stats['misses'] += 1
+
+    query = Product.query
+    if search:
+        query = query.filter(product_search_clause(search))
+    pagination = keyset_paginate(query, Product.id, search, rank=product_search_rank(search))
+    pagination.items = [product_row(p) for p in pagination.items]
+
+    if catalog_cache is not None:
+        tags = ['catalog'] + [f"product:{p['id']}" for p in pagination.items]
+        catalog_cache.set(key, pagination, tags)
+    return pagination
+# -------------------------------------------------------------------
+
+# ---------------------------页面片段缓存------------------------------
+# 列表页的表格行和分页导航渲染一次后把 HTML 存起来，模板里这样用：
+#   {% call cached_fragment('store_order_rows', orders, archived) %} ... {% endcall %}
+# 键由片段名和参数算出：行列表取每行的 id 和 version（订单还带上所含商品的 version），分页取页码和游标。
+# 数据一改版本号就变，键随之变化，不用主动失效，旧片段靠 TTL 和 LRU 淘汰
+FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE', 'local')  # local / off / sqlite:///共享缓存文件路径
+FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL', 600))
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 4096))
+# 模板编译结果的磁盘缓存目录（off 关闭），新 worker 启动时直接加载字节码；模板文件改动后 Jinja 会重新编译。
+# 缓存里是会被直接执行的字节码，目录必须只有应用自己的用户可写，所以默认放在 instance 目录下而不是公共的 /tmp
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja'))
+
+fragment_cache = make_cache(FRAGMENT_CACHE, max_entries=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL)
+fragment_stats = {'hits': 0, 'misses': 0}
+
+if TEMPLATE_CACHE_DIR != 'off':
+    os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+    os.makedirs(TEMPLATE_CACHE_DIR, mode=0o700, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+def precompile_templates():
+    """启动时编译全部模板放进 Jinja 的内存缓存，请求里不再编译；返回模板源码摘要，作为片段缓存键的一部分，
+    这样共享缓存里改版前渲染的片段不会被新模板用到"""
+    digest = hashlib.blake2b(digest_size=8)
+    for name in sorted(app.jinja_env.list_templates()):
+        digest.update(app.jinja_env.loader.get_source(app.jinja_env, name)[0].encode())
+        app.jinja_env.get_template(name)
+    return digest.hexdigest()
+
+TEMPLATE_DIGEST = precompile_templates()
+
+def _row_version(row):
+    if isinstance(row, dict):  # 目录缓存里的商品字典
+        return [row['id'], row.get('version')]
+    if isinstance(row, Order):  # 订单行里还显示商品名称、分类，商品改动也要体现在键里
+        return [row.id, row.version, [item.product.version for item in row.items]]
+    return [row.id, row.version]
+
+def _fragment_part(value):
+    if isinstance(value, KeysetPagination):
+        return [value.page, value.pages, value.has_prev, value.has_next, value.first_id, value.last_id]
+    if isinstance(value, list):
+        return [_row_version(row) for row in value]
+    return value
+
+@app.template_global()
+def cached_fragment(name, *parts, caller):
+    """供 {% call %} 使用：键相同时直接返回上次渲染的 HTML，否则渲染块内容并存入缓存"""
+    if fragment_cache is None:
+        return caller()
+    values = json.dumps([_fragment_part(part) for part in parts], ensure_ascii=False, default=str)
+    key = f"fragment:{name}:{TEMPLATE_DIGEST}:{hashlib.blake2b(values.encode(), digest_size=16).hexdigest()}"
+    html = fragment_cache.get(key)
+    if html is None:
+        fragment_stats['misses'] += 1
+        html = str(caller())
+        fragment_cache.set(key, html)
+    else:
+        fragment_stats['hits'] += 1
+    return Markup(html)
+# -------------------------------------------------------------------
+
+# ---------------------------静态资源------------------------------
+# 启动时把 static/ 下的文件按内容哈希生成带指纹的副本放进 ASSET_DIR，模板里用 asset_url('css/site.css') 引用，
+# 由 /assets/ 返回并允许浏览器缓存一年（immutable）：内容一变文件名就变，不会用到旧文件。
+# CSS/JS 等文本另存 gzip、brotli 预压缩版本，按 Accept-Encoding 直接返回；ASSET_IMAGE_WIDTHS 里的图片
+# 另生成窄屏尺寸和 WebP 版本，CSS 里用 image-set() 和媒体查询挑选。已生成的文件不会重复生成
+ASSET_DIR = os.environ.get('ASSET_DIR', os.path.join(tempfile.gettempdir(), 'yiren_store_assets'))
+ASSET_URL_PATH = '/assets'
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_COMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt')
+ASSET_IMAGE_WIDTHS = {'background.jpg': (768,)}  # 图片 -> 要额外生成的宽度（像素）
+ASSET_IMAGE_QUALITY = 80
+ASSET_IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP'}
+CSS_URL_PATTERN = re.compile(r'url\("?([^")]+)"?\)')
+
+def _built_name(name, digest):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{digest}{ext}'
+
+def _write_file(path, data):
+    """先写临时文件再改名，多个 worker 同时启动时不会读到写了一半的文件"""
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _write_asset(built, make_data):
+    """输出文件不存在时才调用 make_data() 生成；文本文件先写好预压缩版本，最后写原文件"""
+    path = os.path.join(ASSET_DIR, built)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = make_data()
+    if built.endswith(ASSET_COMPRESS_EXTENSIONS):
+        _write_file(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write_file(path + '.br', brotli.compress(data))
+    _write_file(path, data)
+
+def _resize_image(data, width, ext):
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert('RGB')
+        if width and width < image.width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, ASSET_IMAGE_FORMATS[ext], quality=ASSET_IMAGE_QUALITY, optimize=True)
+        return out.getvalue()
+
+def _image_variants(name, data, digest):
+    """原图的 WebP 版本和各宽度的原格式/WebP 版本，返回 逻辑名 -> 输出文件名；没装 Pillow 时都指向原图"""
+    stem, ext = os.path.splitext(name)
+    variants = {}
+    for width in (None, *ASSET_IMAGE_WIDTHS[name]):
+        base = stem if width is None else f'{stem}-{width}'
+        for variant_ext in dict.fromkeys((ext, '.webp')):
+            variant = base + variant_ext
+            if variant == name:
+                continue
+            if Image is None:
+                variants[variant] = _built_name(name, digest)
+                continue
+            built = _built_name(variant, digest)  # 按原图内容命名，已生成过就不用再解码缩放
+            _write_asset(built, lambda: _resize_image(data, width, variant_ext))
+            variants[variant] = built
+    return variants
+
+def build_assets():
+    """生成 static/ 下全部文件的带指纹副本，返回 逻辑名 -> 输出文件名 的清单"""
+    names = sorted(
+        os.path.relpath(os.path.join(root, filename), app.static_folder).replace(os.sep, '/')
+        for root, _, files in os.walk(app.static_folder) for filename in files
+    )
+    manifest = {}
+    for name in names:
+        if name.endswith('.css'):
+            continue
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            data = f.read()
+        digest = hashlib.blake2b(data, digest_size=6).hexdigest()
+        manifest[name] = _built_name(name, digest)
+        _write_asset(manifest[name], lambda: data)
+        if name in ASSET_IMAGE_WIDTHS:
+            manifest.update(_image_variants(name, data, digest))
+
+    for name in names:  # CSS 最后处理，把里面引用的图片换成带指纹的地址
+        if not name.endswith('.css'):
+            continue
+        with open(os.path.join(app.static_folder, name), encoding='utf-8') as f:
+            css = f.read()
+
+        def fingerprint_url(match, name=name):
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(name), match.group(1)))
+            built = manifest.get(target)
+            return f'url("{ASSET_URL_PATH}/{built}")' if built else match.group(0)
+
+        data = CSS_URL_PATTERN.sub(fingerprint_url, css).encode()
+        manifest[name] = _built_name(name, hashlib.blake2b(data, digest_size=6).hexdigest())
+        _write_asset(manifest[name], lambda: data)
+    return manifest
+
+try:
+    asset_manifest = build_assets()
+except OSError as e:  # ASSET_DIR 不可写时退回 Flask 默认的 /static/，页面照常可用
+    app.logger.exception(e)
+    asset_manifest = {}
+
+@app.template_global()
+def asset_url(name):
+    """static/ 下文件的带指纹地址，清单里没有时退回普通的 /static/ 地址"""
+    built = asset_manifest.get(name)
+    if built is None:
+        return url_for('static', filename=name)
+    return url_for('asset', filename=built)
+
+@app.route(ASSET_URL_PATH + '/<path:filename>')
+def asset(filename):
+    path = safe_join(ASSET_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+            response = send_file(path + suffix, mimetype=mimetypes.guess_type(filename)[0], max_age=ASSET_MAX_AGE)
+            response.content_encoding = encoding
+            break
+    if response is None:
+        response = send_from_directory(ASSET_DIR, filename, max_age=ASSET_MAX_AGE)
+    if filename.endswith(ASSET_COMPRESS_EXTENSIONS):
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+# -------------------------------------------------------------------
+
+# ---------------------------服务端会话------------------------------
+# Cookie 里只存随机会话号，会话内容放在服务端；登录校验只查进程内缓存或本地文件，不查数据库
+# 默认用 instance 目录下的 SQLite 文件，多个 worker 共用，重启进程也不会退出登录；
+# 目录只有应用自己的用户可访问，不放在公共的 /tmp，免得别的用户预先建好文件塞进伪造的会话。
+# local 只存在当前进程内存里，仅适合单进程，需显式设置；cookie 为 Flask 原来的签名 Cookie 会话
+SESSION_STORE_DEFAULT = 'sqlite:///' + os.path.join(app.instance_path, 'sessions.db')
+SESSION_STORE = os.environ.get('SESSION_STORE', SESSION_STORE_DEFAULT)
+SESSION_LIFETIME = int(os.environ.get('SESSION_LIFETIME', 7 * 24 * 3600))  # 会话最后一次修改后的有效秒数
+SESSION_STORE_SIZE = int(os.environ.get('SESSION_STORE_SIZE', 10000))  # 进程内最多保存的会话数，超出时淘汰最久未用的
+# 只有带登录身份的会话才存到服务端；未登录时只有 flash 提示之类的少量内容，签名后直接放在 Cookie 里，
+# 这样大量匿名请求不会占满会话存储、把已登录的会话挤掉
+SESSION_AUTH_KEYS = ('store_logged_in', 'customer_id')
+
+class ServerSession(CallbackDict, SessionMixin):
+    """服务端会话，内容有修改时才写回存储"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+class ServerSessionInterface(SessionInterface):
+    """替换 Flask 默认的签名 Cookie 会话，会话按登录身份打标签，撤销时按标签删除"""
+
+    def __init__(self, store):
+        self.store = store
+        self.cookie_sessions = SecureCookieSessionInterface()  # 借用它的签名序列化保存未登录会话
+
+    def open_session(self, app, request):
+        if request.path.startswith((ASSET_URL_PATH + '/', app.static_url_path + '/')):
+            return self.make_null_session(app)  # 静态资源与登录身份无关，不查会话，也不加 Vary: Cookie
+        value = request.cookies.get(self.get_cookie_name(app))
+        if value and '.' in value:  # 会话号里没有点，带点的是签名过的未登录会话内容
+            try:
+                data = self.cookie_sessions.get_signing_serializer(app).loads(value, max_age=SESSION_LIFETIME)
+                return ServerSession(data)
+            except BadSignature:
+                pass
+        elif value:
+            data = self.store.get('session:' + value)
+            if data is not None:
+                return ServerSession(data, value)
+        return ServerSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if self.is_null_session(session):
+            return
+        response.vary.add('Cookie')
+        if not session.modified:
+            return
+        authenticated = any(session.get(key) for key in SESSION_AUTH_KEYS)
+        if session.sid is not None and not authenticated:  # 已退出登录，服务端的会话不再需要
+            self.store.delete('session:' + session.sid)
+            session.sid = None
+        if not session:
+            if not session.new:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if authenticated:
+            if session.sid is None:
+                session.sid = secrets.token_urlsafe(32)
+            tags = []
+            if session.get('store_logged_in'):
+                tags.append('store')
+            if session.get('customer_id'):
+                tags.append(f"customer:{session['customer_id']}")
+            self.store.set('session:' + session.sid, dict(session), tags)
+            value = session.sid
+        else:
+            value = self.cookie_sessions.get_signing_serializer(app).dumps(dict(session))
+        response.set_cookie(name, value, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+session_store = None
+if SESSION_STORE != 'cookie':
+    if SESSION_STORE == SESSION_STORE_DEFAULT:
+        os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+    # 会话内容按 Flask 签名 Cookie 的格式存成 JSON，不用 pickle，读到被篡改的存储文件也不会执行代码
+    session_store = make_cache(SESSION_STORE, max_entries=SESSION_STORE_SIZE, ttl=SESSION_LIFETIME,
+                               serializer=TaggedJSONSerializer())
+    app.session_interface = ServerSessionInterface(session_store)
+
+def rotate_session():
+    """登录成功后换一个新的会话号，防止会话固定攻击；新会话号在保存会话时分配"""
+    if not isinstance(session, ServerSession):
+        return
+    if session.sid is not None:
+        session_store.delete('session:' + session.sid)
+    session.sid = None
+    session.modified = True
+
+def revoke_sessions(tag):
+    """让带某个标签的全部会话立即失效，如 'customer:3'、'store'；使用签名 Cookie 会话时无法撤销"""
+    if session_store is None:
+        return False
+    session_store.invalidate([tag])
+    return True
+
+LOGIN_ROLES = {
+    'store': ('store_logged_in', 'store_login'),
+    'customer': ('customer_id', 'customer_login'),
+}
+
+def login_required(role):
+    """视图装饰器，role 为 'store' 或 'customer'，未登录时提示并跳转到对应的登录页"""
+    key, login_endpoint = LOGIN_ROLES[role]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not session.get(key):
+                if request.path.startswith(API_PREFIX):
+                    return jsonify(error='请先登录'), 401
+                flash('请先登录')
+                return redirect(url_for(login_endpoint))
+            return view(*args, **kwargs)
+        wrapper.login_role = role  # 供 check-queries 判断页面需要哪种登录
+        return wrapper
+    return decorator
+# -------------------------------------------------------------------
+
+# ---------------------------读写分离------------------------------
+# 配置了 DATABASE_REPLICA_URLS 时，标记为 @read_only 的页面在 GET 请求里把查询轮流发往健康的副本；
+# 副本延迟过大或连不上时退回主库；本会话刚写过数据的一小段时间内也读主库，保证能看到自己的修改
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))             # 允许的复制延迟秒数
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', 10))  # 每个副本的健康检查间隔
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5)) # 写入后继续读主库的秒数
+
+_replica_health = {}  # 副本 -> (是否可用, 检查时间)
+_replica_turn = itertools.count()
+
+def replica_lag(conn):
+    """副本落后主库的秒数；SQLite 没有复制，视为 0"""
+    if conn.dialect.name != 'postgresql':
+        return 0.0
+    return conn.execute(text(
+        'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+        'ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END'
+    )).scalar()
+
+def replica_healthy(key):
+    healthy, checked_at = _replica_health.get(key, (False, None))
+    now = time.monotonic()
+    if checked_at is not None and now - checked_at < REPLICA_CHECK_SECONDS:
+        return healthy
+    try:
+        with db.engines[key].connect() as conn:
+            lag = replica_lag(conn)
+        healthy = lag <= REPLICA_MAX_LAG
+        if not healthy:
+            app.logger.warning('只读副本 %s 延迟 %.1fs，暂时改读主库', key, lag)
+    except Exception as e:
+        healthy = False
+        app.logger.warning('只读副本 %s 不可用，暂时改读主库：%s', key, e)
+    _replica_health[key] = (healthy, now)
+    return healthy
+
+def choose_replica():
+    """轮流挑一个健康的副本，没有可用副本或本会话刚写过数据时返回 None（读主库）"""
+    if not REPLICA_KEYS or session.get('primary_until', 0) > time.time():
+        return None
+    start = next(_replica_turn)
+    for i in range(len(REPLICA_KEYS)):
+        key = REPLICA_KEYS[(start + i) % len(REPLICA_KEYS)]
+        if replica_healthy(key):
+            return db.engines[key]
+    return None
+
+def read_only(view):
+    """视图装饰器：GET 请求里的查询走只读副本"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET':
+            g.read_replica = choose_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _read_own_writes(db_session):
+    if REPLICA_KEYS and has_request_context():
+        session['primary_until'] = time.time() + REPLICA_STICKY_SECONDS
+# -------------------------------------------------------------------
+
+# ---------------------------限流与准入控制------------------------------
+# 促销时下单、登录请求暴增会占满全部 worker 和数据库连接，店家页面也跟着打不开。
+# 对这些路由分组做两层限制，超出时立即返回 429，多余的请求不占着 worker 排队：
+#   令牌桶：每个顾客每分钟 rate 次，最多连续 burst 次；未登录时按提交的用户名计数（登录、注册），
+#   设置了 PROXY_COUNT 能拿到真实 IP 时再按 IP 另计一份，两份都有余量才放行
+#   并发上限：同一分组同时处理的请求不超过 concurrency 个，等空位最多 wait 秒，等待时间见 /metrics
+# 店家页面不属于任何分组，不受限制。
+# ADMISSION_CONTROL=local 时在进程内计数（sync 模式每个进程同时只处理一个请求，并发上限只在 threads 模式下起作用）；
+# sqlite:///路径 时同一台机器上的所有 worker 共用一个 SQLite 文件计数；off 关闭
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'local')
+ADMISSION_MAX_KEYS = 100000  # 进程内最多保存的令牌桶数，超出时淘汰最久未用的
+ADMISSION_SLOT_TTL = 120     # 共享计数里占用超过这么多秒的空位视为 worker 已退出，不再计入
+ADMISSION_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# 计数范围内能同时处理的请求数：local 为本进程，sqlite 为本机全部 worker
+_admission_capacity = (WEB_THREADS if WEB_MODE == 'threads' else 1) * \
+    (int(os.environ.get('WEB_CONCURRENCY', 1)) if ADMISSION_CONTROL.startswith('sqlite:///') else 1)
+
+def _admission_group(name, rate, burst, concurrency, wait):
+    """分组的默认限制，可用 ADMISSION_<分组>_RATE/BURST/CONCURRENCY/WAIT 环境变量覆盖"""
+    prefix = f'ADMISSION_{name.upper()}_'
+    return {'rate': float(os.environ.get(prefix + 'RATE', rate)),
+            'burst': int(os.environ.get(prefix + 'BURST', burst)),
+            'concurrency': int(os.environ.get(prefix + 'CONCURRENCY', concurrency)),
+            'wait': float(os.environ.get(prefix + 'WAIT', wait))}
+
+# 默认下单最多占一半处理能力，登录/注册（密码哈希很耗 CPU）最多占四分之一，其余留给店家页面和浏览商品
+ADMISSION_GROUPS = {
+    'checkout': _admission_group('checkout', rate=20, burst=5, concurrency=max(1, _admission_capacity // 2), wait=0.5),
+    'login': _admission_group('login', rate=10, burst=5, concurrency=max(1, _admission_capacity // 4), wait=0.5),
+}
+
+admission_wait = {}      # 分组 -> Histogram，等待并发空位的秒数
+admission_rejected = {}  # (分组, 原因) -> 次数，原因为 rate / concurrency
+
+class LocalAdmission:
+    """进程内的令牌桶和并发计数"""
+
+    def __init__(self, max_keys=ADMISSION_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (令牌数, 更新时间)
+        self._in_flight = {}           # 分组 -> 正在处理的请求数
+        self._cond = threading.Condition()
+
+    def take(self, key, rate, burst):
+        """取一个令牌（rate 为每秒补充的令牌数），取到返回 0，否则返回还要等的秒数"""
+        now = time.monotonic()
+        with self._cond:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens if retry_after else tokens - 1, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def acquire(self, group, limit, timeout):
+        """占一个并发空位，最多等 timeout 秒，没等到返回 False"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._in_flight.get(group, 0) >= limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self._in_flight[group] = self._in_flight.get(group, 0) + 1
+            return True
+
+    def release(self, group):
+        with self._cond:
+            self._in_flight[group] -= 1
+            self._cond.notify()
+
+    def in_flight(self):
+        with self._cond:
+            return dict(self._in_flight)
+
+class SqliteAdmission:
+    """同一台机器上多个 worker 共用的令牌桶和并发计数，和 SqliteCache 一样用本地 SQLite 文件代替独立服务"""
+    POLL_SECONDS = 0.01
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS admission_buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS admission_slots (id INTEGER PRIMARY KEY, grp TEXT, acquired REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_admission_slots_grp ON admission_slots (grp, acquired)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+            self._local.slots = {}
+        return conn
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT tokens, updated FROM admission_buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = 0 if tokens >= 1 else (1 - tokens) / rate
+            conn.execute('INSERT OR REPLACE INTO admission_buckets VALUES (?, ?, ?)',
+                         (key, tokens if retry_after else tokens - 1, now))
+            if random.random() < 0.001:  # 偶尔清理早已补满的令牌桶
+                conn.execute('DELETE FROM admission_buckets WHERE updated < ?', (now - 3600,))
+        return retry_after
+
+    def acquire(self, group, limit, timeout):
+        deadline = time.monotonic() + timeout
+        conn = self._conn()
+        while True:
+            now = time.time()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('DELETE FROM admission_slots WHERE grp = ? AND acquired < ?',
+                             (group, now - ADMISSION_SLOT_TTL))
+                busy = conn.execute('SELECT count(*) FROM admission_slots WHERE grp = ?', (group,)).fetchone()[0]
+                if busy < limit:
+                    self._local.slots[group] = conn.execute(
+                        'INSERT INTO admission_slots (grp, acquired) VALUES (?, ?)', (group, now)).lastrowid
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.POLL_SECONDS)
+
+    def release(self, group):
+        conn = self._conn()
+        conn.execute('DELETE FROM admission_slots WHERE id = ?', (self._local.slots.pop(group),))
+
+    def in_flight(self):
+        return dict(self._conn().execute('SELECT grp, count(*) FROM admission_slots GROUP BY grp').fetchall())
+
+def make_admission(url):
+    if url == 'off':
+        return None
+    if url.startswith('sqlite:///'):
+        return SqliteAdmission(url[len('sqlite:///'):])
+    return LocalAdmission()
+
+admission_backend = make_admission(ADMISSION_CONTROL)
+
+def _admission_rejected(group, reason, retry_after):
+    with _metrics_lock:
+        admission_rejected[(group, reason)] = admission_rejected.get((group, reason), 0) + 1
+    message = '当前请求人数较多，请稍后再试'
+    response = (jsonify(error=message) if request.path.startswith(API_PREFIX)
+                else Response(message, mimetype='text/plain'))
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response
+
+_proxy_warning_logged = False
+
+def _warn_no_proxy_count():
+    """未设置 PROXY_COUNT 时 remote_addr 可能是反向代理的地址，按 IP 限流会让所有顾客共用一个令牌桶，
+    所以未登录的请求只按用户名计数；发现 X-Forwarded-For 时提醒一次"""
+    global _proxy_warning_logged
+    if not _proxy_warning_logged and 'X-Forwarded-For' in request.headers:
+        _proxy_warning_logged = True
+        app.logger.warning('请求带有 X-Forwarded-For 但未设置 PROXY_COUNT，未登录请求只按用户名限流')
+
+def admission(group, methods=('POST',), form_key=None):
+    """视图装饰器：methods 里的请求先过分组的令牌桶和并发上限，超出时直接返回 429。
+    form_key 为表单里的用户名字段，未登录时按它计数，挡住对同一账号的连续尝试"""
+    limits = ADMISSION_GROUPS[group]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if admission_backend is None or request.method not in methods:
+                return view(*args, **kwargs)
+            customer_id = session.get('customer_id')
+            keys = []
+            if customer_id:
+                keys.append(f'{group}:customer:{customer_id}')
+            else:
+                username = (request.form.get(form_key) or '').strip()[:100] if form_key else ''
+                if username:
+                    keys.append(f'{group}:user:{username}')
+                if PROXY_COUNT:
+                    keys.append(f'{group}:ip:{request.remote_addr}')
+                else:
+                    _warn_no_proxy_count()
+            for key in keys:
+                retry_after = admission_backend.take(key, limits['rate'] / 60, limits['burst'])
+                if retry_after:
+                    return _admission_rejected(group, 'rate', retry_after)
+
+            started = time.perf_counter()
+            acquired = admission_backend.acquire(group, limits['concurrency'], limits['wait'])
+            with _metrics_lock:
+                admission_wait.setdefault(group, Histogram(ADMISSION_WAIT_BUCKETS)).observe(
+                    time.perf_counter() - started)
+            if not acquired:
+                return _admission_rejected(group, 'concurrency', limits['wait'])
+            try:
+                return view(*args, **kwargs)
+            finally:
+                admission_backend.release(group)
+        return wrapper
+    return decorator
+# -------------------------------------------------------------------
+
+# ---------------------------库存预留工具------------------------------
+STOCK_RETRIES = int(os.environ.get('STOCK_RETRIES', 3))  # 锁冲突/死锁时的重试次数
+CART_MAX_ITEMS = 50  # 单个订单最多包含的商品种数
+
+class OutOfStock(Exception):
+    """库存不足或商品不存在，整笔订单需要回滚"""
+
+def reserve_stock(items):
+    """原子扣减库存：一条带条件的 UPDATE，只有每个商品库存都够时才全部扣减。
+    items 为 {商品id: 数量}，返回 {商品id: (价格, 分类)}；失败抛出 OutOfStock，由调用方回滚事务"""
+    if not items:
+        return {}
+    quantity = case(items, value=Product.id, else_=0)
+    reserved = db.session.execute(
+        update(Product)
+        .where(Product.id.in_(items), Product.stock >= quantity)
+        .values(stock=Product.stock - quantity)
+        .returning(Product.id, Product.price, Product.category)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if len(reserved) != len(items):
+        raise OutOfStock()
+    record_changes(Product, [product_id for product_id, _, _ in reserved], 'update')
+    return {product_id: (price, category) for product_id, price, category in reserved}
+
+def release_stock(items):
+    """归还库存，items 为 {商品id: 数量}，一条 UPDATE 完成"""
+    if not items:
+        return
+    quantity = case(items, value=Product.id, else_=0)
+    db.session.execute(
+        update(Product)
+        .where(Product.id.in_(items))
+        .values(stock=Product.stock + quantity)
+        .execution_options(synchronize_session=False)
+    )
+    record_changes(Product, list(items), 'update')
+
+def parse_cart(form):
+    """把表单里成对的 product_id / quantity 合并成 {商品id: 数量}，未填写购买量的行忽略"""
+    items = {}
+    for product_id, quantity in zip(form.getlist('product_id'), form.getlist('quantity')):
+        if not quantity.strip():
+            continue
+        product_id = int(product_id)
+        quantity = int(quantity)
+        if quantity < 0:
+            raise ValueError('购买量不能为负数')
+        if quantity:
+            items[product_id] = items.get(product_id, 0) + quantity
+    return items
+
+def create_order(customer, phone, address, items, customer_id=None):
+    """扣库存、插订单、批量插订单项、更新销售汇总，语句数与商品种数无关"""
+    reserved = reserve_stock(items)
+    total = sum(reserved[product_id][0] * quantity for product_id, quantity in items.items())
+    order_id, created_at = db.session.execute(
+        insert(Order).values(customer=customer, phone=phone, address=address, total=total,
+                             customer_id=customer_id)
+        .returning(Order.id, Order.created_at)
+    ).one()
+    db.session.execute(insert(OrderItem), [
+        {'order_id': order_id, 'product_id': product_id, 'quantity': quantity,
+         'unit_price': reserved[product_id][0]}
+        for product_id, quantity in items.items()
+    ])
+    record_changes(Order, [order_id], 'insert')
+    record_sales(created_at, [
+        (product_id, reserved[product_id][1], quantity, reserved[product_id][0])
+        for product_id, quantity in items.items()
+    ])
+    return order_id
+
+def describe_shortage(items):
+    """下单失败后用一次 IN 查询找出不存在或库存不足的商品"""
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(items))}
+    missing = [str(product_id) for product_id in items if product_id not in products]
+    if missing:
+        return f"商品不存在：{'、'.join(missing)}"
+    short = [p.name for p in products.values() if p.stock < items[p.id]]
+    return f"库存不足：{'、'.join(short)}"
+
+def run_with_retry(work, retries=STOCK_RETRIES):
+    """执行一个完整事务，遇到锁等待超时、死锁等可重试错误时回滚后退避重试"""
+    for attempt in range(retries + 1):
+        try:
+            return work()
+        except OperationalError:
+            db.session.rollback()
+            if attempt == retries:
+                raise
+            time.sleep(0.01 * 2 ** attempt + random.random() * 0.01)
+
+@app.cli.command('bench-reserve')
+@click.option('--threads', default=16, help='并发线程数')
+@click.option('--stock', default=2000, help='热门商品的初始库存')
+def bench_reserve(threads, stock):
+    """多线程同时抢购同一个商品，验证不会超卖并输出吞吐量"""
+    hot = Product(name='压测商品', price=1.0, stock=stock, category='压测')
+    db.session.add(hot)
+    db.session.commit()
+    hot_id = hot.id
+
+    sold = []
+    failed = []
+
+    def buyer():
+        with app.app_context():
+            while True:
+                def checkout():
+                    create_order('压测', '0', '压测', {hot_id: 1})
+                    db.session.commit()
+                try:
+                    run_with_retry(checkout)
+                    sold.append(1)
+                except OutOfStock:
+                    db.session.rollback()
+                    return
+                except Exception as e:
+                    db.session.rollback()
+                    failed.append(e)
+                    return
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=buyer) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    db.session.expire_all()
+    remaining = db.session.get(Product, hot_id).stock
+    ordered = db.session.query(func.coalesce(func.sum(OrderItem.quantity), 0)).filter_by(product_id=hot_id).scalar()
+    print(f'线程数 {threads}，初始库存 {stock}，成交 {len(sold)} 单，剩余库存 {remaining}，异常 {len(failed)}')
+    print(f'耗时 {elapsed:.2f}s，吞吐量 {len(sold) / elapsed:.1f} 单/秒')
+
+    # 清理压测数据
+    order_ids = select(OrderItem.order_id).where(OrderItem.product_id == hot_id).scalar_subquery()
+    db.session.execute(delete(OrderItem).where(OrderItem.product_id == hot_id))
+    db.session.execute(delete(Order).where(Order.id.in_(order_ids)))
+    db.session.execute(delete(Product).where(Product.id == hot_id))
+    db.session.execute(delete(ProductSales).where(ProductSales.product_id == hot_id))
+    db.session.execute(delete(DailySales).where(DailySales.category == '压测'))
+    db.session.commit()
+
+    if remaining < 0 or ordered != stock - remaining or failed:
+        print('超卖或数据不一致！')
+        raise SystemExit(1)
 # -------------------------------------------------------------------
 
-# ---------------------------初始化数据库------------------------------
-with app.app_context():
-    db.create_all()
+# ---------------------------进货入库工具------------------------------
+RECEIVED_STATUS = '已处理'   # 进货单改为该状态即视为到货入库
+CANCELLED_STATUS = '已取消'
+RECEIVE_BATCH_SIZE = 1000
+
+def upsert_products(rows, add_stock):
+    """按 (商品名, 分类) 写入商品，一批只发一条语句。
+    add_stock 为 True 时已有商品只累加库存（进货入库），否则用新的价格和库存覆盖（CSV 导入）"""
+    if not rows:
+        return
+    products = Product.__table__
+    dialect = db.engine.dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        stmt = dialect_insert(products).values(rows)
+        if add_stock:
+            set_ = {'stock': products.c.stock + stmt.excluded.stock}
+        else:
+            set_ = {'stock': stmt.excluded.stock, 'price': stmt.excluded.price}
+        # ON CONFLICT 的更新分支不会带上列的 onupdate，更新时间和版本号要写明
+        set_.update(updated_at=func.now(), version=products.c.version + 1)
+        stmt = stmt.on_conflict_do_update(index_elements=[products.c.name, products.c.category], set_=set_)
+        record_changes(Product, db.session.execute(stmt.returning(products.c.id)).scalars().all(), 'upsert')
+        return
+
+    # 其他数据库：先批量更新已有商品，再插入缺少的商品
+    keyed = {(row['name'], row['category']): row for row in rows}
+    existing = {(name, category): product_id for product_id, name, category in db.session.execute(
+        select(products.c.id, products.c.name, products.c.category)
+        .where(tuple_(products.c.name, products.c.category).in_(list(keyed)))
+    )}
+    for name, category in existing:
+        row = keyed[(name, category)]
+        values = ({'stock': products.c.stock + row['stock']} if add_stock
+                  else {'stock': row['stock'], 'price': row['price']})
+        db.session.execute(
+            update(products)
+            .where(products.c.name == name, products.c.category == category)
+            .values(**values)
+        )
+    missing = [key for key in keyed if key not in existing]
+    inserted = []
+    if missing:
+        db.session.execute(insert(products), [keyed[key] for key in missing])
+        inserted = db.session.execute(
+            select(products.c.id).where(tuple_(products.c.name, products.c.category).in_(missing))
+        ).scalars().all()
+    record_changes(Product, list(existing.values()) + inserted, 'upsert')
+
+def upsert_stock(totals):
+    """按 (商品名, 分类) 增加库存，不存在的商品以进货价新建。
+    totals 为 {(商品名, 分类): (数量, 进货价)}"""
+    upsert_products([{'name': name, 'category': category, 'stock': quantity, 'price': price}
+                     for (name, category), (quantity, price) in totals.items()], add_stock=True)
+
+def receive_purchases(purchase_ids):
+    """进货单入库，返回本次入库的单数。
+    先用一条 UPDATE ... RETURNING 认领尚未入库的单（同一张单只会被认领一次，重复提交不会重复加库存），
+    再按商品汇总后一次性加库存"""
+    received = 0
+    for start in range(0, len(purchase_ids), RECEIVE_BATCH_SIZE):
+        batch = purchase_ids[start:start + RECEIVE_BATCH_SIZE]
+        claimed = db.session.execute(
+            update(Purchase)
+            .where(Purchase.id.in_(batch), Purchase.received_at.is_(None),
+                   Purchase.status != CANCELLED_STATUS)
+            .values(status=RECEIVED_STATUS, received_at=func.now())
+            .returning(Purchase.id, Purchase.product_name, Purchase.product_category,
+                       Purchase.product_quantity, Purchase.product_price)
+            .execution_options(synchronize_session=False)
+        ).all()
+        record_changes(Purchase, [row[0] for row in claimed], 'update')
+        claimed = [row[1:] for row in claimed]
+
+        totals = {}
+        for name, category, quantity, price in claimed:
+            stock, _ = totals.get((name, category), (0, price))
+            totals[(name, category)] = (stock + quantity, price)
+        upsert_stock(totals)
+        record_purchases(claimed)
+        received += len(claimed)
+    return received
+
+@app.cli.command('bench-receive')
+@click.option('--lines', default=5000, help='进货单数量')
+@click.option('--products', 'distinct', default=500, help='涉及的不同商品数')
+def bench_receive(lines, distinct):
+    """批量创建进货单并一次入库，输出耗时并校验库存和幂等性"""
+    category = f'入库压测{int(time.time())}'
+    db.session.execute(insert(Purchase), [
+        {'owner': '压测', 'phone': '0', 'address': '压测', 'product_name': f'商品{i % distinct}',
+         'product_price': 1.0, 'product_category': category, 'product_quantity': 1}
+        for i in range(lines)
+    ])
+    db.session.commit()
+    purchase_ids = list(db.session.execute(
+        select(Purchase.id).where(Purchase.product_category == category)).scalars())
+
+    start = time.perf_counter()
+    received = receive_purchases(purchase_ids)
+    db.session.commit()
+    elapsed = time.perf_counter() - start
+
+    again = receive_purchases(purchase_ids)
+    db.session.commit()
+
+    stock = db.session.query(func.sum(Product.stock)).filter(Product.category == category).scalar()
+    print(f'{lines} 张进货单 / {distinct} 种商品，入库 {received} 张，耗时 {elapsed:.3f}s，'
+          f'{lines / elapsed:.0f} 张/秒')
+    print(f'重复入库 {again} 张，库存合计 {stock}')
+
+    db.session.execute(delete(Purchase).where(Purchase.product_category == category))
+    db.session.execute(delete(Product).where(Product.category == category))
+    db.session.execute(delete(DailyPurchases).where(DailyPurchases.category == category))
+    db.session.commit()
+
+    if received != lines or again != 0 or stock != lines:
+        print('入库结果不一致！')
+        raise SystemExit(1)
+# -------------------------------------------------------------------
 
+# ---------------------------销售与库存统计------------------------------
+LOW_STOCK_THRESHOLD = int(os.environ.get('LOW_STOCK_THRESHOLD', 10))
+
+def upsert_increment(model, keys, counters, rows):
+    """汇总表按主键累加：不存在的行插入，存在的行把 counters 列加上新值，一批只发一条语句"""
+    if not rows:
+        return
+    table_ = model.__table__
+    dialect = db.engine.dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        stmt = dialect_insert(table_).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table_.c[k] for k in keys],
+            set_={c: table_.c[c] + stmt.excluded[c] for c in counters},
+        )
+        db.session.execute(stmt)
+        return
+
+    for row in rows:
+        result = db.session.execute(
+            update(table_)
+            .where(*[table_.c[k] == row[k] for k in keys])
+            .values(**{c: table_.c[c] + row[c] for c in counters})
+        )
+        if result.rowcount == 0:
+            db.session.execute(insert(table_).values(row))
+
+def _day_of(moment):
+    return moment.date() if isinstance(moment, datetime) else moment
+
+def record_sales(created_at, lines, sign=1):
+    """下单（sign=1）或删单（sign=-1）时更新销售汇总，lines 为 (商品id, 分类, 数量, 单价)"""
+    day = _day_of(created_at)
+    by_category = {}
+    by_product = {}
+    for product_id, category, quantity, price in lines:
+        revenue = sign * quantity * price
+        units = sign * quantity
+        row = by_category.setdefault(category, {'day': day, 'category': category, 'revenue': 0, 'units': 0})
+        row['revenue'] += revenue
+        row['units'] += units
+        row = by_product.setdefault(product_id, {'product_id': product_id, 'revenue': 0, 'units': 0})
+        row['revenue'] += revenue
+        row['units'] += units
+    upsert_increment(DailySales, ('day', 'category'), ('revenue', 'units'), list(by_category.values()))
+    upsert_increment(ProductSales, ('product_id',), ('revenue', 'units'), list(by_product.values()))
+
+def record_purchases(claimed, day=None):
+    """进货入库时更新进货汇总，claimed 为 (商品名, 分类, 数量, 进货价)"""
+    day = day or datetime.now(timezone.utc).date()
+    by_category = {}
+    for _, category, quantity, price in claimed:
+        row = by_category.setdefault(category, {'day': day, 'category': category, 'cost': 0, 'units': 0})
+        row['cost'] += quantity * price
+        row['units'] += quantity
+    upsert_increment(DailyPurchases, ('day', 'category'), ('cost', 'units'), list(by_category.values()))
+
+def backfill_analytics(conn):
+    """清空汇总表，按现有订单（含已归档订单）和已入库进货单全量重算"""
+    items = OrderItem.__table__
+    orders = Order.__table__
+    products = Product.__table__
+    purchases = Purchase.__table__
+
+    # 每个订单项一行：(日期, 分类, 商品id, 数量, 单价)
+    sales = select(func.date(orders.c.created_at).label('day'), products.c.category.label('category'),
+                   items.c.product_id.label('product_id'), items.c.quantity.label('quantity'),
+                   func.coalesce(items.c.unit_price, products.c.price).label('unit_price')) \
+        .select_from(items.join(orders, orders.c.id == items.c.order_id)
+                          .join(products, products.c.id == items.c.product_id))
+    if inspect(conn).has_table(ArchivedOrder.__tablename__):  # 归档表由较晚的迁移创建
+        archived_items = ArchivedOrderItem.__table__
+        archived_orders = ArchivedOrder.__table__
+        sales = sales.union_all(
+            select(func.date(archived_orders.c.created_at), archived_items.c.product_category,
+                   archived_items.c.product_id, archived_items.c.quantity, archived_items.c.unit_price)
+            .select_from(archived_items.join(archived_orders, archived_orders.c.id == archived_items.c.order_id))
+        )
+    sales = sales.subquery()
+
+    for model in (DailySales, ProductSales, DailyPurchases):
+        conn.execute(delete(model.__table__))
+
+    conn.execute(insert(DailySales.__table__).from_select(
+        ['day', 'category', 'revenue', 'units'],
+        select(sales.c.day, sales.c.category,
+               func.sum(sales.c.quantity * sales.c.unit_price), func.sum(sales.c.quantity))
+        .group_by(sales.c.day, sales.c.category)
+    ))
+    conn.execute(insert(ProductSales.__table__).from_select(
+        ['product_id', 'revenue', 'units'],
+        select(sales.c.product_id, func.sum(sales.c.quantity * sales.c.unit_price), func.sum(sales.c.quantity))
+        .group_by(sales.c.product_id)
+    ))
+    received_day = func.date(purchases.c.received_at)
+    conn.execute(insert(DailyPurchases.__table__).from_select(
+        ['day', 'category', 'cost', 'units'],
+        select(received_day, purchases.c.product_category,
+               func.sum(purchases.c.product_quantity * purchases.c.product_price),
+               func.sum(purchases.c.product_quantity))
+        .where(purchases.c.received_at.is_not(None))
+        .group_by(received_day, purchases.c.product_category)
+    ))
+
+@app.cli.command('backfill-analytics')
+def backfill_analytics_command():
+    """按现有数据重建统计汇总表"""
+    with db.engine.begin() as conn:
+        backfill_analytics(conn)
+    print('统计汇总表已重建')
+# -------------------------------------------------------------------
+
+# ---------------------------后台任务队列------------------------------
+# 任务记录在 jobs 表里，由 web 进程内的后台线程（JOB_WORKERS 个）或单独的 flask run-jobs 进程执行。
+# 配置了定时任务时 web worker 一启动就开任务线程（gunicorn.conf.py 的 post_worker_init），
+# 否则等第一次提交任务再开；JOB_WORKERS=0 时定时任务必须靠 Procfile 里的 worker 进程
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))  # 每个 web 进程内的任务线程数，0 表示只靠独立 worker
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 2))
+JOB_STALE_MINUTES = 30  # running 超过这么久视为 worker 已崩溃，重新排队
+JOB_CHUNK_SIZE = 1000   # 批量任务每段处理的订单数，每段单独提交
+
+JOB_HANDLERS = {}
+PERIODIC_JOBS = {}  # 定时任务：任务类型 -> 间隔秒数，由任务线程空闲时补排
+_periodic_checked = {}
+_job_wakeup = threading.Event()
+_job_threads_lock = threading.Lock()
+_job_threads_pid = None
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def enqueue_job(kind, payload):
+    """写入一条任务并唤醒本进程的任务线程，返回任务编号"""
+    job = Job(kind=kind, payload=json.dumps(payload, ensure_ascii=False))
+    db.session.add(job)
+    db.session.commit()
+    start_job_threads()
+    _job_wakeup.set()
+    return job.id
+
+def start_job_threads():
+    # gunicorn 在导入后才 fork，线程要在各 worker 进程里首次使用时再启动
+    global _job_threads_pid
+    if JOB_WORKERS <= 0:
+        return
+    with _job_threads_lock:
+        if _job_threads_pid == os.getpid():
+            return
+        _job_threads_pid = os.getpid()
+        for i in range(JOB_WORKERS):
+            threading.Thread(target=job_worker_loop, name=f'job-worker-{i}', daemon=True).start()
+
+def start_periodic_jobs():
+    """web worker 启动后调用：有定时任务时立即启动任务线程，不必等有人提交批量操作"""
+    if PERIODIC_JOBS:
+        if JOB_WORKERS <= 0:
+            app.logger.warning('JOB_WORKERS=0，定时任务只会由 flask run-jobs 进程执行')
+        start_job_threads()
+
+def claim_job():
+    """认领最早的一条排队任务；PostgreSQL 下用 SKIP LOCKED，多个 worker 互不阻塞"""
+    next_id = (select(Job.id).where(Job.status == 'queued').order_by(Job.id).limit(1)
+               .with_for_update(skip_locked=True).scalar_subquery())
+    row = db.session.execute(
+        update(Job)
+        .where(Job.id == next_id, Job.status == 'queued')
+        .values(status='running', started_at=func.now(), attempts=Job.attempts + 1)
+        .returning(Job.id, Job.kind, Job.payload, Job.attempts)
+        .execution_options(synchronize_session=False)
+    ).first()
+    db.session.commit()
+    return row
+
+def requeue_stale_jobs():
+    db.session.execute(
+        update(Job)
+        .where(Job.status == 'running',
+               Job.started_at < datetime.now(timezone.utc) - timedelta(minutes=JOB_STALE_MINUTES))
+        .values(status='queued')
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+def run_one_job():
+    """执行一条任务，没有排队任务时返回 False；失败的任务重试 JOB_MAX_ATTEMPTS 次"""
+    row = claim_job()
+    if row is None:
+        return False
+    job_id, kind, payload, attempts = row
+    try:
+        JOB_HANDLERS[kind](json.loads(payload))
+        values = {'status': 'done', 'finished_at': func.now(), 'error': None}
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception(e)
+        values = {'status': 'failed' if attempts >= JOB_MAX_ATTEMPTS else 'queued',
+                  'finished_at': func.now(), 'error': str(e)[:500]}
+    db.session.execute(update(Job).where(Job.id == job_id).values(**values)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    return True
+
+def enqueue_due_jobs():
+    """定时任务到期时排一条任务：没有排队或执行中的同类任务，且上一条创建已超过间隔；每分钟最多检查一次"""
+    now = time.monotonic()
+    for kind, interval in PERIODIC_JOBS.items():
+        last_checked = _periodic_checked.get(kind)
+        if last_checked is not None and now - last_checked < 60:
+            continue
+        _periodic_checked[kind] = now
+        since = datetime.now(timezone.utc) - timedelta(seconds=interval)
+        recent = db.session.scalar(
+            select(Job.id)
+            .where(Job.kind == kind, (Job.status.in_(('queued', 'running'))) | (Job.created_at >= since))
+            .limit(1)
+        )
+        if recent is None:
+            db.session.add(Job(kind=kind, payload='{}'))
+        db.session.commit()
+
+def job_worker_loop(stop=None):
+    with app.app_context():
+        while stop is None or not stop.is_set():
+            try:
+                enqueue_due_jobs()
+                if run_one_job():
+                    continue
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception(e)
+            _job_wakeup.wait(JOB_POLL_SECONDS)
+            _job_wakeup.clear()
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """独立的后台任务 worker 进程"""
+    requeue_stale_jobs()
+    print('后台任务 worker 已启动')
+    job_worker_loop()
+
+def _chunks(ids, size=JOB_CHUNK_SIZE):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+def set_orders_status(order_ids, status):
+    db.session.execute(
+        update(Order).where(Order.id.in_(order_ids)).values(status=status)
+        .execution_options(synchronize_session=False)
+    )
+    record_changes(Order, order_ids, 'update')
+
+def delete_orders(order_ids):
+    """批量删除订单：汇总后一条 UPDATE 归还库存、冲减销售统计，再批量删除订单项和订单。
+    语句数与订单数无关，返回库存有变化的商品id"""
+    lines = db.session.execute(
+        select(OrderItem.product_id, Product.category, Order.created_at, OrderItem.quantity,
+               func.coalesce(OrderItem.unit_price, Product.price))
+        .join(Order, Order.id == OrderItem.order_id)
+        .join(Product, Product.id == OrderItem.product_id)
+        .where(OrderItem.order_id.in_(order_ids))
+    ).all()
+
+    restore = {}
+    by_day = {}
+    for product_id, category, created_at, quantity, price in lines:
+        restore[product_id] = restore.get(product_id, 0) + quantity
+        by_day.setdefault(_day_of(created_at), []).append((product_id, category, quantity, price))
+    release_stock(restore)
+    for day, day_lines in by_day.items():
+        record_sales(day, day_lines, sign=-1)
+
+    db.session.execute(delete(OrderItem).where(OrderItem.order_id.in_(order_ids)))
+    db.session.execute(delete(Order).where(Order.id.in_(order_ids)))
+    record_changes(Order, order_ids, 'delete')
+    return list(restore)
+
+@job_handler('set_order_status')
+def set_order_status_job(payload):
+    """批量改订单状态：指定 order_ids，或把 from_status 状态的订单全部改掉；按 id 分段提交"""
+    status = payload['status']
+    if 'order_ids' in payload:
+        for chunk in _chunks(payload['order_ids']):
+            set_orders_status(chunk, status)
+            db.session.commit()
+            invalidate_orders(chunk)
+        return
+
+    last_id = 0
+    while True:
+        chunk = list(db.session.execute(
+            select(Order.id).where(Order.status == payload['from_status'], Order.id > last_id)
+            .order_by(Order.id).limit(JOB_CHUNK_SIZE)
+        ).scalars())
+        if not chunk:
+            return
+        set_orders_status(chunk, status)
+        db.session.commit()
+        invalidate_orders(chunk)
+        last_id = chunk[-1]
+
+@job_handler('delete_orders')
+def delete_orders_job(payload):
+    for chunk in _chunks(payload['order_ids']):
+        product_ids = delete_orders(chunk)
+        db.session.commit()
+        invalidate_catalog(product_ids)
+        invalidate_orders(chunk)
+
+# 订单归档：已处理且超过 ARCHIVE_AFTER_DAYS 天的订单定期移到归档表，订单相关页面和导出默认只查热表
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get('ARCHIVE_INTERVAL_HOURS', 24))  # 自动归档的间隔，0 表示不自动执行
+ARCHIVE_STATUS = '已处理'  # 只归档这个状态的订单，待处理的订单无论多旧都留在热表
+
+def archive_cutoff(days=ARCHIVE_AFTER_DAYS):
+    return datetime.now(timezone.utc) - timedelta(days=days)
+
+def needs_archive(start_date):
+    """按创建时间过滤时，只有起始日期早于归档线才可能命中归档表"""
+    return start_date is None or start_date.replace(tzinfo=timezone.utc) < archive_cutoff()
+
+def archive_orders(order_ids):
+    """把订单和订单项整批复制到归档表再从热表删除；库存和销售统计不变"""
+    orders = Order.__table__
+    items = OrderItem.__table__
+    products = Product.__table__
+    db.session.execute(insert(ArchivedOrder.__table__).from_select(
+        ['id', 'customer', 'phone', 'address', 'created_at', 'status', 'total', 'customer_id',
+         'updated_at', 'version'],
+        select(orders.c.id, orders.c.customer, orders.c.phone, orders.c.address, orders.c.created_at,
+               orders.c.status, orders.c.total, orders.c.customer_id, orders.c.updated_at, orders.c.version)
+        .where(orders.c.id.in_(order_ids))
+    ))
+    db.session.execute(insert(ArchivedOrderItem.__table__).from_select(
+        ['id', 'order_id', 'product_id', 'product_name', 'product_category', 'quantity', 'unit_price'],
+        select(items.c.id, items.c.order_id, items.c.product_id, products.c.name, products.c.category,
+               items.c.quantity, func.coalesce(items.c.unit_price, products.c.price))
+        .join(products, products.c.id == items.c.product_id)
+        .where(items.c.order_id.in_(order_ids))
+    ))
+    db.session.execute(delete(OrderItem).where(OrderItem.order_id.in_(order_ids)))
+    db.session.execute(delete(Order).where(Order.id.in_(order_ids)))
+    record_changes(Order, order_ids, 'archive')
+
+@job_handler('archive_orders')
+def archive_orders_job(payload):
+    """归档旧订单，按 id 分段提交"""
+    cutoff = archive_cutoff(payload.get('days', ARCHIVE_AFTER_DAYS))
+    archived = 0
+    last_id = 0
+    while True:
+        chunk = list(db.session.execute(
+            select(Order.id)
+            .where(Order.status == ARCHIVE_STATUS, Order.created_at < cutoff,
+                   Order.id > last_id)
+            .order_by(Order.id).limit(JOB_CHUNK_SIZE)
+        ).scalars())
+        if not chunk:
+            return archived
+        archive_orders(chunk)
+        db.session.commit()
+        invalidate_orders(chunk)
+        archived += len(chunk)
+        last_id = chunk[-1]
+
+if ARCHIVE_INTERVAL_HOURS > 0:
+    PERIODIC_JOBS['archive_orders'] = ARCHIVE_INTERVAL_HOURS * 3600
+
+def order_list_query(archived, search):
+    """订单列表查询，返回 (查询, 模型)：archived 为真时只查归档表，否则只查热表"""
+    if archived:
+        query = ArchivedOrder.query.options(joinedload(ArchivedOrder.items))
+        if search:
+            query = query.filter(ArchivedOrder.items.any(ArchivedOrderItem.product_name.contains(search)))
+        return query, ArchivedOrder
+    query = Order.query.options(joinedload(Order.items).joinedload(OrderItem.product))
+    if search:
+        query = query.filter(Order.items.any(OrderItem.product.has(product_search_clause(search))))
+    return query, Order
+
+@app.cli.command('archive-orders')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, help='归档多少天以前的已处理订单')
+def archive_orders_command(days):
+    """立即归档旧订单"""
+    archived = archive_orders_job({'days': days})
+    print(f'已归档 {archived} 个订单')
+# -------------------------------------------------------------------
+
+# ---------------------------变更记录与增量导出------------------------------
+# 商品、订单、进货单的每次写入都在同一事务里往 change_log 记一行，记录的编号就是断点。
+# 同步方先全量导出一次并保存响应头 X-Checkpoint，之后用 /export/changes?since=断点 只取这之后变化过的行，
+# 每次换成响应头里的新断点；行按编号覆盖、以版本号判断新旧，重复收到同一版本没有影响
+CHANGE_LOG_LOCK_KEY = 20240802  # PostgreSQL advisory lock，让变更记录按提交顺序取编号
+CHANGE_LOG_COMPACT_HOURS = float(os.environ.get('CHANGE_LOG_COMPACT_HOURS', 24))  # 压缩变更记录的间隔，0 表示不自动执行
+CHANGE_FEED_MODELS = {'product': Product, 'order': Order, 'purchase': Purchase}  # 导出类型 -> 记录变更的模型
+CHANGE_TRACKED = tuple(CHANGE_FEED_MODELS.values())
+
+def record_changes(model, ids, op):
+    """批量语句写入后调用，先记在会话里，提交时一条 INSERT 写入；ORM 的增删改由 _record_orm_changes 自动记录"""
+    db.session.info.setdefault('pending_changes', []).extend(
+        {'table_name': model.__tablename__, 'row_id': row_id, 'op': op} for row_id in ids)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _record_orm_changes(db_session, flush_context):
+    rows = []
+    for op, objects in (('insert', db_session.new), ('update', db_session.dirty), ('delete', db_session.deleted)):
+        for obj in objects:
+            if isinstance(obj, CHANGE_TRACKED) and (op != 'update' or db_session.is_modified(obj)):
+                rows.append({'table_name': obj.__tablename__, 'row_id': obj.id, 'op': op})
+    db_session.info.setdefault('pending_changes', []).extend(rows)
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _write_changes(db_session):
+    """事务里记下的变更在提交前才写入 change_log。PostgreSQL 上先拿事务级 advisory lock 再插入，锁到提交才释放，
+    编号的先后就是提交的先后，已提交的最大编号之前不会再冒出新记录；SQLite 同一时间只有一个写事务，本来如此"""
+    db_session.flush()  # 提交时的最后一次 flush 在本事件之后，先 flush 让其中的 ORM 改动也记进来
+    rows = db_session.info.pop('pending_changes', None)
+    if not rows:
+        return
+    conn = db_session.connection()
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOG_LOCK_KEY})
+    conn.execute(insert(ChangeLog.__table__), rows)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_changes(db_session):
+    db_session.info.pop('pending_changes', None)
+
+def change_checkpoint():
+    """已提交的最大变更编号；编号按提交顺序分配（见 _write_changes），同步到这里不会漏掉更早的记录"""
+    return db.session.scalar(select(func.max(ChangeLog.id))) or 0
+
+def change_feed(data_type, since, upto):
+    """返回 (CSV 表头, JSON 键, 查询语句列表)：编号在 (since, upto] 内有变更的行按当前数据导出。
+    已删除的行只有编号，操作列为 delete；已归档的订单从归档表导出，操作列为 archive"""
+    changed = (select(ChangeLog.row_id.label('id'))
+               .where(ChangeLog.table_name == CHANGE_FEED_MODELS[data_type].__tablename__,
+                      ChangeLog.id > since, ChangeLog.id <= upto)
+               .distinct().subquery())
+
+    if data_type == 'product':
+        headers = ['操作', '商品编号', '商品名称', '价格', '库存', '分类', '创建时间', '更新时间', '版本']
+        keys = ('op', 'id', 'name', 'price', 'stock', 'category', 'created_at', 'updated_at', 'version')
+        stmt = (select(case((Product.id.is_(None), 'delete'), else_='upsert'), changed.c.id,
+                       Product.name, Product.price, Product.stock, Product.category, Product.created_at,
+                       Product.updated_at, Product.version)
+                .select_from(changed).outerjoin(Product, Product.id == changed.c.id)
+                .order_by(changed.c.id))
+        return headers, keys, [stmt]
+
+    if data_type == 'purchase':
+        headers = ['操作', '货单编号', '货主姓名', '手机号码', '进货地址', '创建时间', '商品名称', '价格',
+                   '分类', '进货量', '状态', '入库时间', '更新时间', '版本']
+        keys = ('op', 'id', 'owner', 'phone', 'address', 'created_at', 'product_name', 'product_price',
+                'product_category', 'product_quantity', 'status', 'received_at', 'updated_at', 'version')
+        stmt = (select(case((Purchase.id.is_(None), 'delete'), else_='upsert'), changed.c.id,
+                       Purchase.owner, Purchase.phone, Purchase.address, Purchase.created_at,
+                       Purchase.product_name, Purchase.product_price, Purchase.product_category,
+                       Purchase.product_quantity, Purchase.status, Purchase.received_at,
+                       Purchase.updated_at, Purchase.version)
+                .select_from(changed).outerjoin(Purchase, Purchase.id == changed.c.id)
+                .order_by(changed.c.id))
+        return headers, keys, [stmt]
+
+    # 订单与 export() 一样每个订单项一行，订单项随订单创建和删除，不单独记录变更
+    headers = ['操作', '订单编号', '顾客姓名', '手机号码', '收件地址', '创建时间', '商品名称', '价格', '分类',
+               '购买量', '状态', '订单金额', '更新时间', '版本']
+    keys = ('op', 'id', 'customer', 'phone', 'address', 'created_at', 'product_name', 'unit_price', 'category',
+            'quantity', 'status', 'total', 'updated_at', 'version')
+    stmt = (select(case((Order.id.is_(None), 'delete'), else_='upsert'), changed.c.id,
+                   Order.customer, Order.phone, Order.address, Order.created_at, Product.name,
+                   func.coalesce(OrderItem.unit_price, Product.price), Product.category, OrderItem.quantity,
+                   Order.status, Order.total, Order.updated_at, Order.version)
+            .select_from(changed)
+            .outerjoin(Order, Order.id == changed.c.id)
+            .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+            .outerjoin(Product, Product.id == OrderItem.product_id)
+            .outerjoin(ArchivedOrder, ArchivedOrder.id == changed.c.id)
+            .where(ArchivedOrder.id.is_(None))
+            .order_by(changed.c.id, OrderItem.id))
+    archived_stmt = (select(literal('archive'), ArchivedOrder.id, ArchivedOrder.customer, ArchivedOrder.phone,
+                            ArchivedOrder.address, ArchivedOrder.created_at, ArchivedOrderItem.product_name,
+                            ArchivedOrderItem.unit_price, ArchivedOrderItem.product_category,
+                            ArchivedOrderItem.quantity, ArchivedOrder.status, ArchivedOrder.total,
+                            ArchivedOrder.updated_at, ArchivedOrder.version)
+                     .join(changed, changed.c.id == ArchivedOrder.id)
+                     .join(ArchivedOrderItem, ArchivedOrderItem.order_id == ArchivedOrder.id)
+                     .order_by(ArchivedOrder.id, ArchivedOrderItem.id))
+    return headers, keys, [stmt, archived_stmt]
+
+@job_handler('compact_change_log')
+def compact_change_log_job(payload):
+    """每行只保留最新的一条变更记录：增量导出只看断点之后有没有变更，删掉更早的记录结果不变。按编号分段提交"""
+    newer = ChangeLog.__table__.alias('newer')
+    superseded = (select(newer.c.id)
+                  .where(newer.c.table_name == ChangeLog.table_name, newer.c.row_id == ChangeLog.row_id,
+                         newer.c.id > ChangeLog.id)
+                  .exists())
+    removed = 0
+    last_id = 0
+    while True:
+        chunk = list(db.session.execute(
+            select(ChangeLog.id).where(ChangeLog.id > last_id, superseded)
+            .order_by(ChangeLog.id).limit(JOB_CHUNK_SIZE)
+        ).scalars())
+        if not chunk:
+            return removed
+        db.session.execute(delete(ChangeLog).where(ChangeLog.id.in_(chunk)))
+        db.session.commit()
+        removed += len(chunk)
+        last_id = chunk[-1]
+
+if CHANGE_LOG_COMPACT_HOURS > 0:
+    PERIODIC_JOBS['compact_change_log'] = CHANGE_LOG_COMPACT_HOURS * 3600
+
+@app.cli.command('compact-change-log')
+def compact_change_log_command():
+    """立即压缩变更记录"""
+    removed = compact_change_log_job({})
+    print(f'已删除 {removed} 条过时的变更记录')
+# -------------------------------------------------------------------
+
+# ---------------------------CSV 批量导入------------------------------
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+IMPORT_MAX_ERRORS = 100  # 报告里最多列出的错误条数
+IMPORT_HEADERS = {  # 与 export() 导出的列一致
+    'product': ['商品名称', '价格', '库存', '分类', '创建时间'],
+    'purchase': ['货单编号', '货主姓名', '手机号码', '进货地址', '创建时间',
+                 '商品名称', '价格', '分类', '进货量', '状态'],
+}
+
+def _parse_created_at(value):
+    value = value.strip()
+    return datetime.fromisoformat(value) if value else datetime.now(timezone.utc)
+
+def _required(value, field, max_length=100):
+    value = value.strip()
+    if not value:
+        raise ValueError(f'{field}不能为空')
+    if len(value) > max_length:
+        raise ValueError(f'{field}超过{max_length}个字符')
+    return value
+
+IMPORT_MAX_INTEGER = 2 ** 31 - 1  # 库存、进货量是 Integer 列
+
+def _non_negative(value, field, kind, maximum=IMPORT_MAX_INTEGER):
+    try:
+        number = kind(value)
+    except (ValueError, ArithmeticError):  # 含 parse_money 拒绝的超范围金额
+        raise ValueError(f'{field}不是有效的数字或超出范围')
+    if number < 0:
+        raise ValueError(f'{field}不能小于0')
+    if number > maximum:  # 在这里拦下，否则要到写库时才溢出，连累整批
+        raise ValueError(f'{field}不能大于{maximum}')
+    return number
+
+def _optional_id(value, field):
+    value = value.strip()
+    return _non_negative(value, field, int) if value else None
+
+def parse_product_row(row):
+    name, price, stock, category, created_at = row
+    return {'name': _required(name, '商品名称'), 'price': _non_negative(price, '价格', parse_money, MAX_MONEY),
+            'stock': _non_negative(stock, '库存', int), 'category': _required(category, '分类'),
+            'created_at': _parse_created_at(created_at)}
+
+def parse_purchase_row(row):
+    purchase_id, owner, phone, address, created_at, name, price, category, quantity, status = row
+    created = _parse_created_at(created_at)
+    status = status.strip() or '待处理'
+    return {'id': _optional_id(purchase_id, '货单编号'),
+            'owner': _required(owner, '货主姓名'), 'phone': _required(phone, '手机号码'),
+            'address': _required(address, '进货地址'), 'created_at': created,
+            'product_name': _required(name, '商品名称'),
+            'product_price': _non_negative(price, '价格', parse_money, MAX_MONEY),
+            'product_category': _required(category, '分类', 50),
+            'product_quantity': _non_negative(quantity, '进货量', int), 'status': status,
+            # 导入的已处理进货单视为已入库，不再重复加库存
+            'received_at': created if status == RECEIVED_STATUS else None}
+
+def upsert_purchases(rows):
+    """按货单编号写入进货单：编号已存在的覆盖，不存在的按原编号插入，没填编号的作为新进货单插入。
+    这样重复导入同一份导出文件不会多出进货单"""
+    purchases = Purchase.__table__
+    keyed = {row['id']: row for row in rows if row['id'] is not None}  # 同一批里重复的编号以最后一行为准
+    fresh = [{key: value for key, value in row.items() if key != 'id'} for row in rows if row['id'] is None]
+    existing = set(db.session.scalars(select(purchases.c.id).where(purchases.c.id.in_(list(keyed))))) if keyed else set()
+
+    if existing:
+        fields = [key for key in next(iter(keyed.values())) if key not in ('id', 'received_at')]
+        # 已入库的进货单保留原入库时间，避免之后改状态时重复加库存；updated_at、version 由列的 onupdate 更新
+        db.session.execute(
+            update(purchases).where(purchases.c.id == bindparam('b_id'))
+            .values(**{key: bindparam('b_' + key) for key in fields},
+                    received_at=func.coalesce(purchases.c.received_at, bindparam('b_received_at'))),
+            [{'b_' + key: value for key, value in keyed[purchase_id].items()} for purchase_id in existing])
+        record_changes(Purchase, list(existing), 'update')
+
+    inserted = []
+    missing = [keyed[purchase_id] for purchase_id in keyed if purchase_id not in existing]
+    if missing:
+        inserted += db.session.scalars(insert(Purchase).returning(Purchase.id), missing).all()
+        if db.engine.dialect.name == 'postgresql':  # 显式指定了 id，序列要跟上
+            db.session.execute(text(
+                "SELECT setval(pg_get_serial_sequence('purchases', 'id'), "
+                "(SELECT coalesce(max(id), 1) FROM purchases))"))
+    if fresh:
+        inserted += db.session.scalars(insert(Purchase).returning(Purchase.id), fresh).all()
+    record_changes(Purchase, inserted, 'insert')
+
+def _write_import_batch(kind, rows):
+    if kind == 'product':
+        # 同一批里重复的 (商品名, 分类) 以最后一行为准，ON CONFLICT 不允许一条语句改同一行两次
+        upsert_products(list({(r['name'], r['category']): r for r in rows}.values()), add_stock=False)
+    else:
+        upsert_purchases(rows)
+
+def import_csv(kind, lines):
+    """逐行读取 CSV，校验后按批写入，每批单独提交；返回导入报告"""
+    parse_row = parse_product_row if kind == 'product' else parse_purchase_row
+    width = len(IMPORT_HEADERS[kind])
+    report = {'rows': 0, 'imported': 0, 'batches': 0, 'failed_batches': 0, 'errors': [], 'error_count': 0}
+
+    def error(message):
+        report['error_count'] += 1
+        if len(report['errors']) < IMPORT_MAX_ERRORS:
+            report['errors'].append(message)
+
+    def flush(batch, line_numbers):
+        try:
+            _write_import_batch(kind, batch)
+            db.session.commit()
+            report['imported'] += len(batch)
+            report['batches'] += 1
+        except Exception as e:
+            db.session.rollback()
+            report['failed_batches'] += 1
+            error(f'第{line_numbers[0]}-{line_numbers[-1]}行中的 {len(batch)} 行写入失败：{e.__class__.__name__}')
+
+    batch, line_numbers = [], []  # line_numbers 记下每条数据的源文件行号，跳过的行不会算进去
+    for line_no, row in enumerate(csv.reader(lines), start=1):
+        if line_no == 1 and row and row[0].lstrip('\ufeff') == IMPORT_HEADERS[kind][0]:
+            continue  # 跳过表头
+        if not any(cell.strip() for cell in row):
+            continue
+        report['rows'] += 1
+        try:
+            if len(row) != width:
+                raise ValueError(f'应有{width}列，实际{len(row)}列')
+            batch.append(parse_row(row))
+        except (ValueError, ArithmeticError) as e:
+            error(f'第{line_no}行：{e}')
+            continue
+        line_numbers.append(line_no)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush(batch, line_numbers)
+            batch, line_numbers = [], []
+    if batch:
+        flush(batch, line_numbers)
+
+    if kind == 'product':
+        invalidate_catalog()
+    return report
+
+@app.cli.command('import-csv')
+@click.argument('kind', type=click.Choice(['product', 'purchase']))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_csv_command(kind, path):
+    """从 CSV 文件批量导入商品或进货单"""
+    start = time.perf_counter()
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        report = import_csv(kind, f)
+    elapsed = time.perf_counter() - start
+    print(f"读取 {report['rows']} 行，导入 {report['imported']} 行，"
+          f"{report['batches']} 批成功，{report['failed_batches']} 批失败，耗时 {elapsed:.1f}s")
+    for message in report['errors']:
+        print('  ' + message)
+    if report['error_count'] > len(report['errors']):
+        print(f"  ……共 {report['error_count']} 条错误")
+# -------------------------------------------------------------------
+
+# ---------------------------SQL 计数工具------------------------------
+# 各页面允许执行的 SQL 条数上限，与数据量无关；flask check-queries 按此检查
+QUERY_BUDGETS = {
+    '/product': 3,
+    '/product?search=苹果': 3,
+    '/order': 3,
+    '/order?search=苹果': 3,
+    '/order?archived=1': 3,
+    '/purchase': 3,
+    '/product_view': 3,
+    '/product_view?page=2&after=10': 3,
+    '/ordering': 3,
+    '/order_view': 3,
+    '/order_view?search=苹果': 3,
+    '/order_view?archived=1': 3,
+    '/export?data_type=product': 2,
+    '/export?data_type=order': 3,
+    '/export?data_type=purchase': 2,
+    '/export/changes?data_type=product&since=0': 2,
+    '/export/changes?data_type=order&since=0&format=ndjson': 3,
+    '/export/changes?data_type=purchase&since=0': 2,
+}
+
+@contextmanager
+def count_queries():
+    """记录代码块内执行的全部 SQL 语句"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+@app.cli.command('check-queries')
+def check_queries():
+    """逐个请求列表页，检查每个视图执行的 SQL 条数不超过预算"""
+    client = app.test_client()
+    customer_id = db.session.scalar(select(Customer.id).limit(1))
+    with client.session_transaction() as sess:
+        sess['store_logged_in'] = True
+        if customer_id is not None:
+            sess['customer_id'] = customer_id
+    adapter = app.url_map.bind('localhost')
+
+    failed = False
+    for path, budget in QUERY_BUDGETS.items():
+        endpoint, _ = adapter.match(path.split('?', 1)[0])
+        if customer_id is None and getattr(app.view_functions[endpoint], 'login_role', None) == 'customer':
+            # 没有顾客账号时这些页面只会跳转到登录页，计数没有意义
+            print(f'SKIP {path}: 数据库里还没有顾客账号，先注册一个顾客再检查')
+            continue
+        _count_cache.clear()
+        with count_queries() as statements:
+            response = client.get(path)
+            response.get_data()  # 流式响应要读完才会执行完查询
+        ok = response.status_code == 200 and len(statements) <= budget
+        failed = failed or not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {path}: {len(statements)} 条 SQL（上限 {budget}），状态码 {response.status_code}")
+        if not ok:
+            for statement in statements:
+                print('      ' + ' '.join(statement.split())[:200])
+
+    if failed:
+        raise SystemExit(1)
+# -------------------------------------------------------------------
+
+# ---------------------------性能基准测试------------------------------
+# flask bench-seed 往空数据库里写入指定规模的压测数据，flask bench 通过测试客户端多线程请求真实路由，
+# 输出各场景的吞吐量、延迟分位数和每个请求的 SQL 条数；--save/--compare 用于发布前对比基线
+BENCH_PASSWORD = 'bench-password'
+BENCH_USER_PREFIX = 'bench-user-'
+BENCH_CATEGORIES = ('水果', '饮料', '零食', '日用品', '粮油')
+
+def seed_benchmark(products, orders, items_per_order, customers, days=365, batch_size=10000):
+    """批量写入压测数据，id 从 1 开始连续分配，调用方需保证相关表为空"""
+    rng = random.Random(42)
+    now = datetime.now(timezone.utc)
+
+    def created(rng):
+        return now - timedelta(seconds=rng.randint(0, days * 86400))
+
+    prices = [Decimal(rng.randint(100, 10000)).scaleb(-2) for _ in range(products)]
+    for start in range(0, products, batch_size):
+        db.session.execute(insert(Product), [
+            {'id': i + 1, 'name': f'压测商品{i + 1}', 'price': prices[i], 'stock': 10 ** 6,
+             'category': BENCH_CATEGORIES[i % len(BENCH_CATEGORIES)], 'created_at': created(rng)}
+            for i in range(start, min(start + batch_size, products))
+        ])
+        db.session.commit()
+
+    password_hash = hash_password(BENCH_PASSWORD)  # 所有压测账号共用一个哈希，省去逐个计算
+    for start in range(0, customers, batch_size):
+        db.session.execute(insert(Customer), [
+            {'id': i + 1, 'username': f'{BENCH_USER_PREFIX}{i + 1}', 'password_hash': password_hash}
+            for i in range(start, min(start + batch_size, customers))
+        ])
+        db.session.commit()
+
+    item_id = 0
+    per_order = min(items_per_order, products)
+    for start in range(0, orders, batch_size):
+        order_rows = []
+        item_rows = []
+        for order_id in range(start + 1, min(start + batch_size, orders) + 1):
+            customer_id = rng.randint(1, customers)
+            total = 0
+            for product_id in rng.sample(range(1, products + 1), per_order):
+                item_id += 1
+                quantity = rng.randint(1, 5)
+                total += prices[product_id - 1] * quantity
+                item_rows.append({'id': item_id, 'order_id': order_id, 'product_id': product_id,
+                                  'quantity': quantity, 'unit_price': prices[product_id - 1]})
+            order_rows.append({'id': order_id, 'customer': f'{BENCH_USER_PREFIX}{customer_id}',
+                               'phone': '13800000000', 'address': '压测地址', 'created_at': created(rng),
+                               'status': rng.choice(('待处理', '已处理')), 'total': total,
+                               'customer_id': customer_id})
+        db.session.execute(insert(Order), order_rows)
+        db.session.execute(insert(OrderItem), item_rows)
+        db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':  # 显式指定了 id，序列要跟上
+        for model in (Product, Customer, Order, OrderItem):
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{model.__tablename__}', 'id'), "
+                f"(SELECT coalesce(max(id), 1) FROM {model.__tablename__}))"))
+    backfill_analytics(db.session.connection())
+    db.session.execute(text('ANALYZE'))  # 刷新统计信息，否则 SQLite 对大表会选错执行计划
+    db.session.commit()
+    invalidate_catalog()
+    return {'products': products, 'customers': customers, 'orders': orders, 'order_items': item_id}
+
+@app.cli.command('bench-seed')
+@click.option('--products', default=100000, help='商品数')
+@click.option('--orders', default=1000000, help='订单数')
+@click.option('--items-per-order', default=5, help='每个订单的商品种数')
+@click.option('--customers', default=1000, help='顾客账号数')
+def bench_seed(products, orders, items_per_order, customers):
+    """往空数据库写入压测数据，默认 10 万商品、500 万订单项"""
+    for model in (Product, Customer, Order):
+        if db.session.scalar(select(model.id).limit(1)) is not None:
+            raise click.ClickException(f'{model.__tablename__} 表已有数据，请对空数据库执行（DATABASE_URL 指向压测库）')
+    started = time.perf_counter()
+    counts = seed_benchmark(products, orders, items_per_order, customers)
+    print('，'.join(f'{name} {count}' for name, count in counts.items()) +
+          f'，耗时 {time.perf_counter() - started:.1f}s')
+
+def bench_scenarios(max_product_id, usernames):
+    """场景名 -> 根据随机数生成 (方法, 路径, 表单数据)，参数随机化以免全部命中同一条缓存"""
+    today = datetime.now(timezone.utc).date().isoformat()
+
+    def ordering(rng):
+        product_ids = rng.sample(range(1, max_product_id + 1), min(3, max_product_id))
+        return 'POST', '/ordering', {'customer': '压测', 'phone': '13800000000', 'address': '压测地址',
+                                     'product_id': [str(pid) for pid in product_ids],
+                                     'quantity': ['1'] * len(product_ids)}
+
+    def customer_login(rng):
+        return 'POST', '/customer_login', {'username': rng.choice(usernames), 'password': BENCH_PASSWORD}
+
+    return {
+        'product_view': lambda rng: ('GET', f'/product_view?page={rng.randint(1, 50)}', None),
+        'product_search': lambda rng: ('GET', f'/product_view?search=压测商品{rng.randint(1, max_product_id)}', None),
+        'api_products': lambda rng: ('GET', f'/api/v1/products?after={rng.randint(0, max_product_id)}', None),
+        'ordering': ordering,
+        'order': lambda rng: ('GET', f'/order?page={rng.randint(1, 50)}', None),
+        'order_view': lambda rng: ('GET', '/order_view', None),
+        'export': lambda rng: ('GET', f'/export?data_type=order&start_date={today}', None),
+        'customer_login': customer_login,
+    }
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+class HttpClient:
+    """压测用的最小 HTTP 客户端，open() 的用法与测试客户端一致；保存 Cookie，不跟随重定向"""
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    class _Result:
+        def __init__(self, status_code, body):
+            self.status_code = status_code
+            self.body = body
+
+        def get_data(self):
+            return self.body
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect)
+
+    def open(self, path, method='GET', data=None):
+        body = urllib.parse.urlencode(data, doseq=True).encode() if data else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                return self._Result(response.status, response.read())
+        except urllib.error.HTTPError as e:  # 重定向和错误状态码都走这里
+            return self._Result(e.code, e.read())
+
+def bench_client(rng, bench_users, base_url=None):
+    """返回一个同时登录了店家和顾客的客户端：不指定 base_url 时用测试客户端直接写会话，否则通过 HTTP 真实登录"""
+    customer_id, username = rng.choice(bench_users)
+    if base_url is None:
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['store_logged_in'] = True
+            sess['customer_id'] = customer_id
+            sess['username'] = username
+        return client
+    client = HttpClient(base_url)
+    client.open('/store_login', method='POST', data={'username': 'zsj', 'password': '123456'})
+    client.open('/customer_login', method='POST', data={'username': username, 'password': BENCH_PASSWORD})
+    return client
+
+def run_scenario(make_request, total, threads, bench_users, base_url=None):
+    """threads 个线程各用一个已登录的客户端，共发出 total 个请求，返回统计结果；
+    请求发往 base_url 上运行的服务时统计不到 SQL 条数"""
+    local = threading.local()
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if hasattr(local, 'sql'):  # 只统计压测线程自己的语句，后台任务线程的不算
+            local.sql += 1
+
+    results = []
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(index)
+        client = bench_client(rng, bench_users, base_url)
+        while True:
+            with counter_lock:
+                if next(counter, None) is None:
+                    return
+            method, path, data = make_request(rng)
+            local.sql = 0
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            response.get_data()  # 流式响应要读完才算结束
+            results.append((time.perf_counter() - started, response.status_code, local.sql))
+
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        start = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+
+    latencies = sorted(r[0] for r in results)
+    sql_counts = [r[2] for r in results]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for r in results if r[1] >= 500),
+        'shed': sum(1 for r in results if r[1] == 429),
+        'throughput': len(results) / elapsed,
+        'p50_ms': _percentile(latencies, 0.5) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'sql_avg': None if base_url else sum(sql_counts) / len(sql_counts),
+        'sql_max': None if base_url else max(sql_counts),
+    }
+
+def load_bench_data(names):
+    """读取压测账号和商品范围，检查场景名，返回 (账号列表, 场景)"""
+    bench_users = db.session.execute(
+        select(Customer.id, Customer.username)
+        .where(Customer.username.startswith(BENCH_USER_PREFIX)).order_by(Customer.id).limit(1000)
+    ).all()
+    max_product_id = db.session.scalar(select(func.max(Product.id)))
+    if not bench_users or not max_product_id:
+        raise click.ClickException('没有压测数据，请先执行 flask bench-seed')
+    bench_users = [tuple(row) for row in bench_users]
+    db.session.remove()
+
+    scenarios = bench_scenarios(max_product_id, [username for _, username in bench_users])
+    unknown = set(names) - set(scenarios)
+    if unknown:
+        raise click.ClickException(f"未知场景：{'、'.join(sorted(unknown))}，可选：{'、'.join(scenarios)}")
+    return bench_users, {name: scenarios[name] for name in names or scenarios}
+
+def run_bench(scenarios, total, threads, bench_users, base_url=None):
+    """逐个场景压测并打印结果表，返回 {场景: 统计结果}"""
+    report = {}
+    print(f"{'场景':<16}{'请求':>6}{'错误':>6}{'限流':>6}{'吞吐量/s':>10}{'p50ms':>9}{'p99ms':>9}{'SQL均值':>9}{'SQL最大':>8}")
+    for name, make_request in scenarios.items():
+        stats = run_scenario(make_request, total, threads, bench_users, base_url)
+        report[name] = stats
+        sql = ('-', '-') if stats['sql_avg'] is None else (f"{stats['sql_avg']:.2f}", stats['sql_max'])
+        print(f"{name:<16}{stats['requests']:>6}{stats['errors']:>6}{stats['shed']:>6}{stats['throughput']:>10.1f}"
+              f"{stats['p50_ms']:>9.1f}{stats['p99_ms']:>9.1f}{sql[0]:>9}{sql[1]:>8}")
+    return report
+
+@app.cli.command('bench')
+@click.option('--threads', default=8, help='并发线程数')
+@click.option('--requests', 'total', default=200, help='每个场景的请求数')
+@click.option('--scenario', 'names', multiple=True, help='只跑指定场景，可重复；默认全部')
+@click.option('--url', 'base_url', help='压测已启动的服务（如 http://127.0.0.1:8000），默认用测试客户端')
+@click.option('--save', type=click.Path(dir_okay=False), help='把结果写入 JSON 文件作为基线')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='与基线 JSON 对比，退化时返回非零')
+@click.option('--tolerance', default=0.5, help='p99 允许比基线慢的比例')
+@click.option('--admission/--no-admission', 'keep_admission', default=False, help='保留限流（默认关闭，只测页面本身）')
+def bench(threads, total, names, base_url, save, compare, tolerance, keep_admission):
+    """对主要页面做并发压测，输出吞吐量、p50/p99 延迟和每请求 SQL 条数"""
+    global admission_backend
+    if not keep_admission:
+        admission_backend = None  # 只影响测试客户端；--url 压测的服务按它自己的 ADMISSION_CONTROL
+    bench_users, scenarios = load_bench_data(names)
+    report = run_bench(scenarios, total, threads, bench_users, base_url)
+
+    if save:
+        with open(save, 'w', encoding='utf-8') as f:
+            json.dump({'threads': threads, 'requests': total, 'scenarios': report}, f, ensure_ascii=False, indent=2)
+    if compare:
+        with open(compare, encoding='utf-8') as f:
+            baseline = json.load(f)['scenarios']
+        regressions = []
+        for name, stats in report.items():
+            base = baseline.get(name)
+            if base is None:
+                continue
+            if stats['errors'] > base['errors']:
+                regressions.append(f"{name}: 错误数 {base['errors']} -> {stats['errors']}")
+            if None not in (stats['sql_avg'], base['sql_avg']) and stats['sql_avg'] > base['sql_avg'] + 0.01:
+                regressions.append(f"{name}: SQL 均值 {base['sql_avg']:.2f} -> {stats['sql_avg']:.2f}")
+            if stats['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+                regressions.append(f"{name}: p99 {base['p99_ms']:.1f}ms -> {stats['p99_ms']:.1f}ms")
+        for line in regressions:
+            print('退化 ' + line)
+        if regressions:
+            raise SystemExit(1)
+
+@app.cli.command('bench-serve')
+@click.option('--mode', 'modes', multiple=True, default=('sync', 'threads'), help='要对比的 WEB_MODE，可重复')
+@click.option('--workers', default=2, help='gunicorn 进程数')
+@click.option('--web-threads', default=WEB_THREADS, help='threads 模式下每个进程的线程数')
+@click.option('--threads', default=32, help='并发客户端数')
+@click.option('--requests', 'total', default=400, help='每个场景的请求数')
+@click.option('--scenario', 'names', multiple=True, help='只跑指定场景，可重复；默认全部')
+@click.option('--port', default=8765, help='临时服务监听的端口')
+@click.option('--admission/--no-admission', 'keep_admission', default=False, help='保留限流（默认关闭，只测页面本身）')
+def bench_serve(modes, workers, web_threads, threads, total, names, port, keep_admission):
+    """用 gunicorn 按不同 WEB_MODE 分别启动服务，以相同负载压测，对比吞吐量和延迟"""
+    bench_users, scenarios = load_bench_data(names)
+    base_url = f'http://127.0.0.1:{port}'
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), WEB_THREADS=str(web_threads), JOB_WORKERS='0',
+               ARCHIVE_INTERVAL_HOURS='0', CHANGE_LOG_COMPACT_HOURS='0')  # 压测期间不跑后台任务
+    session_dir = None
+    if workers > 1 and (SESSION_STORE == 'local' or (keep_admission and ADMISSION_CONTROL == 'local')):
+        session_dir = tempfile.TemporaryDirectory()
+    if SESSION_STORE == 'local' and workers > 1:  # 多进程时进程内会话互相不可见，改用共享的 SQLite 会话
+        env['SESSION_STORE'] = f'sqlite:///{session_dir.name}/sessions.db'
+    if not keep_admission:
+        env['ADMISSION_CONTROL'] = 'off'
+    elif ADMISSION_CONTROL == 'local' and workers > 1:  # 同理，限流计数也改成各进程共用
+        env['ADMISSION_CONTROL'] = f'sqlite:///{session_dir.name}/admission.db'
+
+    reports = {}
+    try:
+        for mode in modes:
+            server = subprocess.Popen(['gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}'],
+                                      cwd=app.root_path, env=dict(env, WEB_MODE=mode))
+            try:
+                deadline = time.monotonic() + 30
+                while True:
+                    try:
+                        HttpClient(base_url).open('/')
+                        break
+                    except OSError:
+                        if time.monotonic() > deadline or server.poll() is not None:
+                            raise click.ClickException(f'{mode} 模式的服务没有启动成功')
+                        time.sleep(0.2)
+                print(f'== WEB_MODE={mode}，{workers} 个进程' + (f' × {web_threads} 线程' if mode == 'threads' else ''))
+                reports[mode] = run_bench(scenarios, total, threads, bench_users, base_url)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        if session_dir is not None:
+            session_dir.cleanup()
+
+    if len(reports) > 1:
+        first, *others = modes
+        print(f'== 吞吐量相对 {first} 模式')
+        for name in scenarios:
+            ratios = '，'.join(f"{mode} {reports[mode][name]['throughput'] / reports[first][name]['throughput']:.2f}x"
+                              for mode in others)
+            print(f'{name:<16}{ratios}')
+
+RENDER_BENCH_PAGES = ('/product', '/product?page=2', '/order', '/order?archived=1', '/purchase',
+                      '/product_view', '/ordering', '/order_view')
+
+@app.cli.command('bench-render')
+@click.option('--requests', 'total', default=50, help='每个页面的请求数')
+def bench_render(total):
+    """对比列表页关闭/开启片段缓存时的模板渲染耗时，以及模板现场编译和从磁盘字节码加载的耗时"""
+    global fragment_cache
+    bench_users, _ = load_bench_data(())
+    client = bench_client(random.Random(0), bench_users)
+    render_times = []
+
+    def on_before(sender, template, context, **extra):
+        render_times.append(-time.perf_counter())
+
+    def on_rendered(sender, template, context, **extra):
+        render_times[-1] += time.perf_counter()
+
+    def measure(path):
+        client.get(path).get_data()  # 先请求一次，片段写入缓存，目录/总数等缓存也都预热好
+        render_times.clear()
+        for _ in range(total):
+            client.get(path).get_data()
+        return sum(render_times) / len(render_times) * 1000
+
+    saved = fragment_cache
+    before_render_template.connect(on_before, app)
+    template_rendered.connect(on_rendered, app)
+    try:
+        print(f"{'页面':<20}{'无片段缓存ms':>12}{'片段缓存ms':>12}{'加速':>8}")
+        for path in RENDER_BENCH_PAGES:
+            fragment_cache = None
+            plain = measure(path)
+            fragment_cache = saved
+            cached = measure(path) if saved is not None else plain
+            print(f'{path:<20}{plain:>12.3f}{cached:>12.3f}{plain / cached:>7.1f}x')
+    finally:
+        fragment_cache = saved
+        before_render_template.disconnect(on_before, app)
+        template_rendered.disconnect(on_rendered, app)
+
+    names = app.jinja_env.list_templates()
+    variants = [('现场编译', None)]
+    if app.jinja_env.bytecode_cache is not None:
+        variants.append(('加载字节码', app.jinja_env.bytecode_cache))
+    for label, bytecode_cache in variants:
+        env = app.jinja_env.overlay(cache_size=0, bytecode_cache=bytecode_cache)
+        started = time.perf_counter()
+        for name in names:
+            env.get_template(name)
+        print(f'{label}全部 {len(names)} 个模板：{(time.perf_counter() - started) * 1000:.1f}ms')
+# -------------------------------------------------------------------
+
+# ---------------------------请求与 SQL 监控---------------------------
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))  # 超过该耗时的 SQL 记录到日志
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # 设置后 /metrics 需要 Bearer token
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+class Histogram:
+    """Prometheus 风格的累积直方图"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+_metrics_lock = threading.Lock()
+request_latency = {}   # (endpoint, method) -> Histogram
+request_sql_count = {} # endpoint -> Histogram
+request_totals = {}    # (endpoint, method, status) -> 次数
+sql_totals = {}        # endpoint -> [语句数, 耗时秒]
+slow_query_total = 0
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    global slow_query_total
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+        g.sql_time += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        with _metrics_lock:
+            slow_query_total += 1
+        app.logger.warning('慢查询 %.1fms [%s]: %s', elapsed * 1000,
+                           request.endpoint if has_request_context() else '-',
+                           ' '.join(statement.split())[:500])
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+
+@app.after_request
+def _record_request(response):
+    if 'request_started' not in g:
+        return response
+    # 流式响应（如导出）这里记录的是首字节时间
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unknown'
+    with _metrics_lock:
+        request_latency.setdefault((endpoint, request.method), Histogram(LATENCY_BUCKETS)).observe(elapsed)
+        request_sql_count.setdefault(endpoint, Histogram(SQL_COUNT_BUCKETS)).observe(g.sql_count)
+        key = (endpoint, request.method, response.status_code)
+        request_totals[key] = request_totals.get(key, 0) + 1
+        totals = sql_totals.setdefault(endpoint, [0, 0.0])
+        totals[0] += g.sql_count
+        totals[1] += g.sql_time
+    return response
+
+def _labels(**labels):
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+def _histogram_lines(name, labels, histogram):
+    lines = []
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {count}')
+    lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {histogram.total}')
+    lines.append(f'{name}_sum{_labels(**labels)} {histogram.sum}')
+    lines.append(f'{name}_count{_labels(**labels)} {histogram.total}')
+    return lines
+
+def render_metrics():
+    """按 Prometheus 文本格式输出本 worker 的指标"""
+    lines = []
+    with _metrics_lock:
+        lines.append('# HELP http_request_duration_seconds 请求耗时')
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for (endpoint, method), histogram in sorted(request_latency.items()):
+            lines += _histogram_lines('http_request_duration_seconds',
+                                      {'endpoint': endpoint, 'method': method}, histogram)
+
+        lines.append('# HELP http_requests_total 请求次数')
+        lines.append('# TYPE http_requests_total counter')
+        for (endpoint, method, status), count in sorted(request_totals.items()):
+            lines.append(f'http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+        lines.append('# HELP db_queries_per_request 每个请求执行的 SQL 条数')
+        lines.append('# TYPE db_queries_per_request histogram')
+        for endpoint, histogram in sorted(request_sql_count.items()):
+            lines += _histogram_lines('db_queries_per_request', {'endpoint': endpoint}, histogram)
+
+        lines.append('# HELP db_queries_total SQL 语句总数')
+        lines.append('# TYPE db_queries_total counter')
+        lines.append('# HELP db_query_seconds_total SQL 总耗时')
+        lines.append('# TYPE db_query_seconds_total counter')
+        for endpoint, (count, seconds) in sorted(sql_totals.items()):
+            lines.append(f'db_queries_total{_labels(endpoint=endpoint)} {count}')
+            lines.append(f'db_query_seconds_total{_labels(endpoint=endpoint)} {seconds}')
+
+        lines.append('# HELP db_slow_queries_total 超过 SLOW_QUERY_MS 的 SQL 条数')
+        lines.append('# TYPE db_slow_queries_total counter')
+        lines.append(f'db_slow_queries_total {slow_query_total}')
+
+    pool = db.engine.pool
+    if hasattr(pool, 'checkedout'):
+        lines.append('# HELP db_pool_connections 本进程连接池中的连接数')
+        lines.append('# TYPE db_pool_connections gauge')
+        lines.append(f'db_pool_connections{_labels(state="checked_out")} {pool.checkedout()}')
+        lines.append(f'db_pool_connections{_labels(state="idle")} {pool.checkedin()}')
+        lines.append(f'db_pool_connections{_labels(state="overflow")} {max(pool.overflow(), 0)}')
+
+    with _metrics_lock:
+        lines.append('# HELP admission_queue_wait_seconds 限流分组里等待并发空位的时间')
+        lines.append('# TYPE admission_queue_wait_seconds histogram')
+        for group, histogram in sorted(admission_wait.items()):
+            lines += _histogram_lines('admission_queue_wait_seconds', {'group': group}, histogram)
+
+        lines.append('# HELP admission_rejected_total 被限流拒绝（429）的请求数')
+        lines.append('# TYPE admission_rejected_total counter')
+        for (group, reason), count in sorted(admission_rejected.items()):
+            lines.append(f'admission_rejected_total{_labels(group=group, reason=reason)} {count}')
+
+    if admission_backend is not None:
+        lines.append('# HELP admission_in_flight 限流分组里正在处理的请求数（local 为本进程，sqlite 为整台机器）')
+        lines.append('# TYPE admission_in_flight gauge')
+        in_flight = admission_backend.in_flight()
+        for group in sorted(ADMISSION_GROUPS):
+            lines.append(f'admission_in_flight{_labels(group=group)} {in_flight.get(group, 0)}')
+
+    lines.append('# HELP catalog_cache_events_total 商品目录缓存命中/未命中/失效次数')
+    lines.append('# TYPE catalog_cache_events_total counter')
+    for event_name, count in sorted(cache_stats.items()):
+        lines.append(f'catalog_cache_events_total{_labels(event=event_name)} {count}')
+
+    lines.append('# HELP fragment_cache_events_total 页面片段缓存命中/未命中次数')
+    lines.append('# TYPE fragment_cache_events_total counter')
+    for event_name, count in sorted(fragment_stats.items()):
+        lines.append(f'fragment_cache_events_total{_labels(event=event_name)} {count}')
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+# -------------------------------------------------------------------
+
+# ---------------------------数据库迁移------------------------------
+# 迁移只在发布时执行一次（flask migrate），不再在每个 worker 启动时 create_all
+schema_migrations = Table(
+    'schema_migrations', db.metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime(timezone=True), server_default=func.now()),
+)
+MIGRATION_LOCK_KEY = 20240801  # PostgreSQL advisory lock，防止多个实例同时迁移
+
+def create_indexes(conn, *names):
+    """按名称创建模型里声明的索引，已存在的跳过"""
+    indexes = {index.name: index for t in db.metadata.tables.values() for index in t.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+def add_column(conn, model, name):
+    """按模型里的定义给已有表加列，列已存在时跳过"""
+    table_name = model.__tablename__
+    if name in {c['name'] for c in inspect(conn).get_columns(table_name)}:
+        return
+    model_column = model.__table__.c[name]
+    ddl = f'ALTER TABLE {table_name} ADD COLUMN {name} {model_column.type.compile(dialect=conn.dialect)}'
+    if model_column.server_default is not None:
+        ddl += f' DEFAULT {model_column.server_default.arg}'
+        if not model_column.nullable:
+            ddl += ' NOT NULL'
+    for fk in model_column.foreign_keys:
+        ddl += f' REFERENCES {fk.column.table.name} ({fk.column.name})'
+    conn.execute(text(ddl))
+
+def add_purchase_received_at(conn):
+    add_column(conn, Purchase, 'received_at')
+    # 以前的“已处理”进货单库存是手工录入的，视为已入库，避免批量入库时重复加库存
+    # 迁移里的 UPDATE 用 table() 只列出用到的列，模型上的 onupdate 列（如 version）这时可能还不存在
+    purchases = table('purchases', column('status'), column('received_at'), column('created_at'))
+    conn.execute(update(purchases)
+                 .where(purchases.c.status == RECEIVED_STATUS, purchases.c.received_at.is_(None))
+                 .values(received_at=purchases.c.created_at))
+
+def convert_money_to_cents(conn):
+    """金额列从浮点元改为整数分，再按整数分重建统计汇总表、回填订单金额。
+    SQLite 不能改列类型，只换算数值，按整数求和同样精确"""
+    for model, name in ((Product, 'price'), (OrderItem, 'unit_price'), (Purchase, 'product_price')):
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text(f'ALTER TABLE {model.__tablename__} ALTER COLUMN {name} '
+                              f'TYPE BIGINT USING round({name} * 100)::bigint'))
+        else:
+            conn.execute(text(f'UPDATE {model.__tablename__} SET {name} = round({name} * 100)'))
+    if conn.dialect.name == 'postgresql':
+        for model, name in ((DailySales, 'revenue'), (ProductSales, 'revenue'), (DailyPurchases, 'cost')):
+            conn.execute(text(f'ALTER TABLE {model.__tablename__} ALTER COLUMN {name} TYPE BIGINT USING 0'))
+    backfill_analytics(conn)
+
+    add_column(conn, Order, 'total')
+    items = OrderItem.__table__
+    products = Product.__table__
+    orders = table('orders', column('id'), column('total'))  # 同 add_purchase_received_at，不带 onupdate 列
+    conn.execute(update(orders).values(total=func.coalesce(
+        select(func.sum(items.c.quantity * func.coalesce(items.c.unit_price, products.c.price)))
+        .select_from(items.join(products, products.c.id == items.c.product_id))
+        .where(items.c.order_id == orders.c.id)
+        .scalar_subquery(), 0)))
+
+def add_change_tracking(conn):
+    """商品、订单、进货单加更新时间和版本号，已有数据的更新时间取创建时间；建变更记录表"""
+    for model in (Product, Order, Purchase, ArchivedOrder):
+        add_column(conn, model, 'updated_at')
+        add_column(conn, model, 'version')
+        conn.execute(text(f'UPDATE {model.__tablename__} SET updated_at = created_at WHERE updated_at IS NULL'))
+    db.metadata.create_all(conn, tables=[ChangeLog.__table__])
+
+def sqlite_autoincrement_ids(conn):
+    """SQLite 的订单、订单项表改用 AUTOINCREMENT，删除最新订单后不再复用其编号（否则新订单会与归档表撞号）。
+    SQLite 不能修改已有表的定义，只能按新定义建表、复制数据后替换；自增起点取热表和归档表里最大的编号。
+    PostgreSQL 的序列本来就不复用编号，无需处理"""
+    if conn.dialect.name != 'sqlite':
+        return
+    for model, archive in ((Order, ArchivedOrder), (OrderItem, ArchivedOrderItem)):
+        name = model.__tablename__
+        ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                           {'name': name}).scalar()
+        if 'AUTOINCREMENT' not in ddl.upper():
+            columns = ', '.join(c.name for c in model.__table__.columns)
+            create = str(CreateTable(model.__table__).compile(conn))
+            conn.execute(text(create.replace(f'CREATE TABLE {name} ', f'CREATE TABLE {name}_new ', 1)))
+            conn.execute(text(f'INSERT INTO {name}_new ({columns}) SELECT {columns} FROM {name}'))
+            conn.execute(text(f'DROP TABLE {name}'))
+            conn.execute(text(f'ALTER TABLE {name}_new RENAME TO {name}'))
+            for index in model.__table__.indexes:
+                index.create(conn)
+
+        seq = max(conn.scalar(select(func.max(model.id))) or 0, conn.scalar(select(func.max(archive.id))) or 0,
+                  conn.scalar(text('SELECT max(seq) FROM sqlite_sequence WHERE name = :name'), {'name': name}) or 0)
+        conn.execute(text('DELETE FROM sqlite_sequence WHERE name = :name'), {'name': name})
+        conn.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'), {'name': name, 'seq': seq})
+
+MIGRATIONS = [
+    (1, '创建数据表', lambda conn: db.metadata.create_all(conn)),
+    (2, '商品名称搜索索引', create_search_index),
+    (3, '常用过滤列索引及商品名称+分类唯一约束', lambda conn: create_indexes(
+        conn,
+        'uq_products_name_category', 'ix_products_created_at',
+        'ix_orders_created_at', 'ix_orders_status',
+        'ix_order_items_order_id', 'ix_order_items_product_id',
+        'ix_purchases_created_at', 'ix_purchases_status',
+    )),
+    (4, '进货单入库时间', add_purchase_received_at),
+    (5, '销售与库存统计汇总表', lambda conn: (
+        add_column(conn, OrderItem, 'unit_price'),
+        db.metadata.create_all(conn, tables=[DailySales.__table__, ProductSales.__table__,
+                                             DailyPurchases.__table__]),
+        create_indexes(conn, 'ix_products_stock'),
+        backfill_analytics(conn),
+    )),
+    (6, '后台任务表', lambda conn: db.metadata.create_all(conn, tables=[Job.__table__])),
+    (7, '订单关联下单账号', lambda conn: (
+        add_column(conn, Order, 'customer_id'),
+        create_indexes(conn, 'ix_orders_customer_id'),
+    )),
+    (8, '金额改为整数分，订单金额列', convert_money_to_cents),
+    (9, '订单归档表', lambda conn: db.metadata.create_all(
+        conn, tables=[ArchivedOrder.__table__, ArchivedOrderItem.__table__])),
+    (10, '更新时间、版本号和变更记录表', add_change_tracking),
+    (11, 'SQLite 订单编号不再复用', sqlite_autoincrement_ids),
+    (12, '商品名称两字关键词索引', create_search_bigrams),
+]
+
+def run_migrations():
+    """在一个事务里按版本号依次执行尚未执行的迁移"""
+    with db.engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        schema_migrations.create(conn, checkfirst=True)
+        applied = set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+        for version, description, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            migrate(conn)
+            conn.execute(insert(schema_migrations).values(version=version, description=description))
+            print(f'已执行迁移 {version}：{description}')
+
+@app.cli.command('migrate')
+def migrate_command():
+    """执行数据库迁移"""
+    run_migrations()
+
+# 关键查询，用于对比加索引前后的执行计划
+EXPLAIN_QUERIES = {
+    '商品查重': lambda: select(Product.id).where(Product.name == '苹果', Product.category == '水果'),
+    '按创建时间导出订单': lambda: select(Order.id).where(Order.created_at >= datetime(2024, 1, 1)),
+    '订单的订单项': lambda: select(OrderItem.id).where(OrderItem.order_id == 1),
+    '商品的订单项': lambda: select(OrderItem.id).where(OrderItem.product_id == 1),
+    '待处理订单': lambda: select(Order.id).where(Order.status == '待处理'),
+    '待处理进货单': lambda: select(Purchase.id).where(Purchase.status == '待处理'),
+}
+
+@app.cli.command('explain-queries')
+def explain_queries():
+    """打印关键查询的执行计划，迁移前后各跑一次即可对比"""
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    for title, build in EXPLAIN_QUERIES.items():
+        stmt = build().compile(db.engine, compile_kwargs={'literal_binds': True})
+        print(f'== {title}')
+        for row in db.session.execute(text(prefix + str(stmt))):
+            print('   ', row[-1])
 # -------------------------------------------------------------------
 
 # --------------------------渲染主页-----------------------------------
@@ -128,6 +3308,7 @@ def store_login():
         username = request.form.get('username')
         password = request.form.get('password')
         if username == 'zsj' and password == '123456':
+            rotate_session()
             session['store_logged_in'] = True
             return redirect(url_for('store_dashboard'))
         else:
@@ -135,33 +3316,26 @@ def store_login():
     return render_template('store/store_login.html')
 
 @app.route('/store_dashboard')
+@login_required('store')
 def store_dashboard():
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
-
     return render_template('store/store_dashboard.html')
 
 @app.route('/store/module/<name>')
+@login_required('store')
 def store_module(name):
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
-    allowed_modules = ['product','order','purchase','export']
+    allowed_modules = ['product','order','purchase','export','analytics']
     if name not in allowed_modules:
         abort(404)
     return redirect(url_for(name))
 
 @app.route('/product',methods = ['GET','POST'])
+@login_required('store')
+@read_only
 def product():
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
-
     if request.method == 'POST':
         try:
             name = request.form.get('name')
-            price = float(request.form.get('price'))
+            price = parse_money(request.form.get('price'))
             stock = int(request.form.get('stock'))
             category = request.form.get('category').strip()
 
@@ -176,117 +3350,124 @@ def product():
             new_product = Product(name=name, price=price, stock=stock, category=category)
             db.session.add(new_product)
             db.session.commit()
+            invalidate_catalog()
             flash('新商品已添加')
 
         except Exception as e:
             db.session.rollback()
-            print(e)
+            app.logger.exception(e)
             flash('新商品添加失败')
 
         return redirect(url_for('product'))
 
-    products = []
-    pagination = None
-
-    if request.method == 'GET':
-        search = request.args.get('search','',type=str)
-        page = request.args.get('page',1,type=int)
-        per_page = 10
+    search = request.args.get('search','',type=str).strip()
 
-        query = Product.query
-        if search:
-            query = query.filter(Product.name.ilike(f'%{search}%'))
+    query = Product.query
+    if search:
+        query = query.filter(product_search_clause(search))
 
-        pagination = query.order_by(Product.id).paginate(page=page, per_page=per_page, error_out=False)
-        products = pagination.items
+    pagination = keyset_paginate(query, Product.id, search, rank=product_search_rank(search))
+    products = pagination.items
 
     return render_template('store/product.html',
-                               products=products,pagination=pagination)
+                               products=products,pagination=pagination,search=search)
 
 @app.route('/delete_product/<int:product_id>' , methods=['POST'])
+@login_required('store')
 def delete_product(product_id):
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
-
     product_delete = Product.query.get_or_404(product_id)
+    if db.session.query(OrderItem.query.filter_by(product_id=product_id).exists()).scalar():
+        flash('该商品已有订单，不能删除')
+        return redirect(url_for('product'))
+
+    db.session.execute(delete(ProductSales).where(ProductSales.product_id == product_id))
     db.session.delete(product_delete)
     db.session.commit()
+    invalidate_catalog()
     flash('该商品已删除')
     return redirect(url_for('product'))
 
 @app.route('/order',methods = ['GET'])
+@login_required('store')
+@read_only
 def order():
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
+    search = request.args.get('search','',type=str).strip()
+    archived = request.args.get('archived') == '1'
 
-    orders = []
-    pagination = None
+    query, model = order_list_query(archived, search)
+    pagination = keyset_paginate(query, model.id, search)
+    orders = pagination.items
 
-    if request.method == 'GET':
-        search = request.args.get('search','',type=str).strip()
-        page = request.args.get('page',1,type=int)
-        per_page = 10
-
-        query = Order.query.options(
-            joinedload(Order.items)
-            .joinedload(OrderItem.product)
-            )
-        if search:
-            query = query.join(Order.items).join(OrderItem.product).filter(Product.name.contains(search))
-
-        pagination = query.order_by(Order.id).paginate(page=page, per_page=per_page, error_out=False)
-        orders = pagination.items
-
-    return render_template('store/order.html',orders=orders,pagination=pagination)
+    return render_template('store/order.html',orders=orders,pagination=pagination,search=search,
+                           archived=archived)
 
 @app.route('/update_order_status/<int:order_id>' , methods=['POST'])
+@login_required('store')
 def update_order_status(order_id):
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
-
-    order_query = Order.query.get_or_404(order_id)
-    order_query.status = request.form.get('status')
+    Order.query.get_or_404(order_id)
+    set_orders_status([order_id], request.form.get('status'))
     db.session.commit()
+    invalidate_orders([order_id])
     flash('该订单状态已更新')
     return redirect(url_for('order'))
 
 @app.route('/delete_order/<int:order_id>' , methods=['POST'])
+@login_required('store')
 def delete_order(order_id):
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
-
+    Order.query.get_or_404(order_id)
     try:
-        order_delete = Order.query.get_or_404(order_id)
-        for item in order_delete.items:
-            item.product.stock += item.quantity
-        db.session.delete(order_delete)
+        product_ids = delete_orders([order_id])
         db.session.commit()
+        invalidate_catalog(product_ids)
+        invalidate_orders([order_id])
         flash('该订单已删除')
 
     except Exception as e:
         db.session.rollback()
-        print(e)
+        app.logger.exception(e)
         flash('订单删除失败')
     
     return redirect(url_for('order'))
 
+@app.route('/batch_orders', methods=['POST'])
+@login_required('store')
+def batch_orders():
+    action = request.form.get('action')
+    order_ids = [int(i) for i in request.form.getlist('order_id')]
+
+    if action == 'process_all_pending':
+        job_id = enqueue_job('set_order_status', {'from_status': '待处理', 'status': '已处理'})
+    elif action in ('process_selected', 'delete_selected') and order_ids:
+        if action == 'process_selected':
+            job_id = enqueue_job('set_order_status', {'order_ids': order_ids, 'status': '已处理'})
+        else:
+            job_id = enqueue_job('delete_orders', {'order_ids': order_ids})
+    else:
+        flash('请先选择订单')
+        return redirect(url_for('order'))
+
+    flash(f'已提交后台任务#{job_id}，稍后刷新查看结果')
+    return redirect(url_for('order'))
+
+@app.route('/jobs')
+@login_required('store')
+def jobs():
+    recent = Job.query.order_by(Job.id.desc()).limit(20).all()
+    return jsonify([{'id': j.id, 'kind': j.kind, 'status': j.status, 'attempts': j.attempts,
+                     'error': j.error, 'created_at': j.created_at, 'finished_at': j.finished_at}
+                    for j in recent])
+
 @app.route('/purchase',methods = ['GET','POST'])
+@login_required('store')
+@read_only
 def purchase():
-   if not session.get('store_logged_in'):
-      flash('请先登录')
-      return redirect(url_for('store_login'))
-
    if request.method == 'POST':
       try:
          owner = request.form.get('owner')
          phone = request.form.get('phone')
          address = request.form.get('address')
          product_name = request.form.get('product_name')
-         product_price = float(request.form.get('product_price'))
+         product_price = parse_money(request.form.get('product_price'))
          product_category = request.form.get('product_category')
          product_quantity = int(request.form.get('product_quantity'))
 
@@ -303,41 +3484,75 @@ def purchase():
 
       except Exception as e:
          db.session.rollback()
-         print(e)
+         app.logger.exception(e)
          flash('进货单创建失败')
 
       return redirect(url_for('purchase'))
 
    search = request.args.get('search','',type=str).strip()
-   page = request.args.get('page',1,type=int)
-   per_page = 10
 
    query = Purchase.query
    if search:
       query = query.filter(Purchase.product_name.ilike(f'%{search}%'))
 
-   pagination = query.order_by(Purchase.id).paginate(page=page, per_page=per_page, error_out=False)
+   pagination = keyset_paginate(query, Purchase.id, search)
    purchases = pagination.items
 
    return render_template('store/purchase.html',
-                               purchases=purchases,pagination=pagination)
+                               purchases=purchases,pagination=pagination,search=search)
 
 @app.route('/update_purchase_status/<int:purchase_id>' , methods=['POST'])
+@login_required('store')
 def update_purchase_status(purchase_id):
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
-
     purchase_query = Purchase.query.get_or_404(purchase_id)
-    purchase_query.status = request.form.get('status')
+    status = request.form.get('status')
+    if status == RECEIVED_STATUS and purchase_query.received_at is None:
+        received = receive_purchases([purchase_id])
+        db.session.commit()
+        invalidate_catalog()
+        flash('该进货单已入库，库存已更新' if received else '该进货单无法入库')
+        return redirect(url_for('purchase'))
+
+    purchase_query.status = status
     db.session.commit()
     flash('该进货单状态已更新')
     return redirect(url_for('purchase'))
 
+@app.route('/receive_purchases', methods=['POST'])
+@login_required('store')
+def receive_purchases_view():
+    try:
+        if request.form.get('all_pending'):
+            purchase_ids = list(db.session.execute(
+                select(Purchase.id).where(Purchase.received_at.is_(None),
+                                          Purchase.status != CANCELLED_STATUS)
+            ).scalars())
+        else:
+            purchase_ids = [int(i) for i in request.form.getlist('purchase_id')]
+
+        if not purchase_ids:
+            flash('请先选择进货单')
+            return redirect(url_for('purchase'))
+
+        received = run_with_retry(lambda: _receive_and_commit(purchase_ids))
+        invalidate_catalog()
+        flash(f'已入库{received}张进货单')
+
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception(e)
+        flash('批量入库失败')
+
+    return redirect(url_for('purchase'))
+
+def _receive_and_commit(purchase_ids):
+    received = receive_purchases(purchase_ids)
+    db.session.commit()
+    return received
+
 @app.route('/delete_purchase/<int:purchase_id>' , methods=['POST'])
+@login_required('store')
 def delete_purchase(purchase_id):
-    if not session.get('store_logged_in'):
-        return redirect(url_for('store_login'))
     purchase_delete = Purchase.query.get_or_404(purchase_id)
     db.session.delete(purchase_delete)
     db.session.commit()
@@ -345,14 +3560,13 @@ def delete_purchase(purchase_id):
     return redirect(url_for('purchase'))
 
 @app.route('/export', methods=['GET'])
+@login_required('store')
+@read_only
 def export():
-    if not session.get('store_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('store_login'))
-
     try:
         data_type = request.args.get('data_type')
         start_date_str = request.args.get('start_date')
+        compress = request.args.get('compress') == 'gzip'
 
         start_date = None
         if start_date_str:
@@ -365,78 +3579,192 @@ def export():
         if not data_type:
             return render_template('store/export.html')  # 还没提交导出请求，直接渲染页面
 
-        # 按类型查询数据，生成 CSV
-        headers = None
-        rows = None
-
+        # 按类型构造查询语句，只取导出需要的列
+        archived_stmts = []
         if data_type == 'product':
-            query = Product.query
-            if start_date:
-                query = query.filter(Product.created_at >= start_date)
-            products = query.all()
-
             headers = ['商品名称', '价格', '库存', '分类', '创建时间']
-            rows = [[p.name, p.price, p.stock, p.category, p.created_at] for p in products]
-
-        elif data_type == 'order':
-            query = Order.query.options(joinedload(Order.items).joinedload(OrderItem.product))
+            stmt = select(Product.name, Product.price, Product.stock,
+                          Product.category, Product.created_at)
             if start_date:
-                query = query.filter(Order.created_at >= start_date)
-            orders = query.all()
+                stmt = stmt.where(Product.created_at >= start_date)
+            stmt = stmt.order_by(Product.id)
 
+        elif data_type == 'order':
             headers = ['订单编号', '顾客姓名', '手机号码', '收件地址', '创建时间',
-                       '商品名称', '价格', '分类', '购买量', '状态']
-            rows = []
-            for o in orders:
-                for item in o.items:
-                    rows.append([
-                        o.id, o.customer, o.phone, o.address, o.created_at,
-                        item.product.name, item.product.price, item.product.category,
-                        item.quantity, o.status
-                    ])
-
-        elif data_type == 'purchase':
-            query = Purchase.query
+                       '商品名称', '价格', '分类', '购买量', '状态', '订单金额']
+            stmt = (select(Order.id, Order.customer, Order.phone, Order.address, Order.created_at,
+                           Product.name, func.coalesce(OrderItem.unit_price, Product.price), Product.category,
+                           OrderItem.quantity, Order.status, Order.total)
+                    .join(OrderItem, OrderItem.order_id == Order.id)
+                    .join(Product, Product.id == OrderItem.product_id))
             if start_date:
-                query = query.filter(Purchase.created_at >= start_date)
-            purchases = query.all()
+                stmt = stmt.where(Order.created_at >= start_date)
+            stmt = stmt.order_by(Order.id, OrderItem.id)
+
+            if needs_archive(start_date):  # 起始日期晚于归档线时不查归档表，归档订单排在前面
+                archived_stmt = (select(ArchivedOrder.id, ArchivedOrder.customer, ArchivedOrder.phone,
+                                        ArchivedOrder.address, ArchivedOrder.created_at,
+                                        ArchivedOrderItem.product_name, ArchivedOrderItem.unit_price,
+                                        ArchivedOrderItem.product_category, ArchivedOrderItem.quantity,
+                                        ArchivedOrder.status, ArchivedOrder.total)
+                                 .join(ArchivedOrderItem, ArchivedOrderItem.order_id == ArchivedOrder.id))
+                if start_date:
+                    archived_stmt = archived_stmt.where(ArchivedOrder.created_at >= start_date)
+                archived_stmts.append(archived_stmt.order_by(ArchivedOrder.id, ArchivedOrderItem.id))
 
+        elif data_type == 'purchase':
             headers = ['货单编号', '货主姓名', '手机号码', '进货地址', '创建时间',
                        '商品名称', '价格', '分类', '进货量', '状态']
-            rows = [[p.id, p.owner, p.phone, p.address, p.created_at,
-                     p.product_name, p.product_price, p.product_category,
-                     p.product_quantity, p.status] for p in purchases]
+            stmt = select(Purchase.id, Purchase.owner, Purchase.phone, Purchase.address,
+                          Purchase.created_at, Purchase.product_name, Purchase.product_price,
+                          Purchase.product_category, Purchase.product_quantity, Purchase.status)
+            if start_date:
+                stmt = stmt.where(Purchase.created_at >= start_date)
+            stmt = stmt.order_by(Purchase.id)
 
         else:
             flash('数据类型不合要求')
             return redirect(url_for('export'))
 
-        # 生成 CSV 并返回
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(headers)
-        writer.writerows(rows)
-
-        response = make_response(output.getvalue())
-        response.headers['Content-Disposition'] = 'attachment; filename=data.csv'
-        response.headers['Content-Type'] = 'text/csv'
+        # 断点在读数据之前取，导出期间的变更下次增量导出会再给一遍
+        checkpoint = change_checkpoint()
+
+        # 边查边写，逐批生成 CSV 返回
+        chunks = stream_csv(headers, *archived_stmts, stmt)
+        filename = 'data.csv'
+        mimetype = 'text/csv'
+        if compress:
+            chunks = gzip_stream(chunks)
+            filename = 'data.csv.gz'
+            mimetype = 'application/gzip'
+
+        response = Response(stream_with_context(chunks), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+        response.headers['X-Checkpoint'] = str(checkpoint)
         return response
 
     except Exception as e:
-        print(e)
+        app.logger.exception(e)
         flash('导出数据失败')
 
     return render_template('store/export.html')
 
+@app.route('/export/changes', methods=['GET'])
+@login_required('store')
+@read_only
+def export_changes():
+    """增量导出：只返回断点 since 之后变更过的行，CSV 或每行一个 JSON；响应头 X-Checkpoint 是下次用的断点"""
+    data_type = request.args.get('data_type')
+    since = request.args.get('since', type=int)
+    output = request.args.get('format', 'csv')
+    if data_type not in CHANGE_FEED_MODELS or since is None or since < 0 or output not in ('csv', 'ndjson'):
+        return jsonify(error='需要 data_type（product/order/purchase）和 since（断点）参数，'
+                             'format 只能是 csv 或 ndjson'), 400
+
+    upto = max(change_checkpoint(), since)  # 压缩变更记录后断点可能比上次小，不往回退
+    headers, keys, stmts = change_feed(data_type, since, upto)
+    if output == 'csv':
+        chunks = stream_csv(headers, *stmts)
+        filename = 'changes.csv'
+        mimetype = 'text/csv'
+    else:
+        chunks = stream_ndjson(keys, *stmts)
+        filename = 'changes.ndjson'
+        mimetype = 'application/x-ndjson'
+    if request.args.get('compress') == 'gzip':
+        chunks = gzip_stream(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['X-Checkpoint'] = str(upto)
+    return response
+
+@app.route('/analytics')
+@login_required('store')
+def analytics():
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+
+    daily = db.session.execute(
+        select(DailySales.day, func.sum(DailySales.revenue), func.sum(DailySales.units))
+        .where(DailySales.day >= since).group_by(DailySales.day).order_by(DailySales.day.desc())
+    ).all()
+    by_category = db.session.execute(
+        select(DailySales.category, func.sum(DailySales.revenue), func.sum(DailySales.units))
+        .where(DailySales.day >= since).group_by(DailySales.category)
+        .order_by(func.sum(DailySales.revenue).desc())
+    ).all()
+    best_sellers = db.session.execute(
+        select(Product.name, Product.category, ProductSales.units, ProductSales.revenue)
+        .join(Product, Product.id == ProductSales.product_id)
+        .where(ProductSales.units > 0)
+        .order_by(ProductSales.units.desc()).limit(10)
+    ).all()
+    low_stock = db.session.execute(
+        select(Product.name, Product.category, Product.stock)
+        .where(Product.stock <= LOW_STOCK_THRESHOLD).order_by(Product.stock).limit(20)
+    ).all()
+    purchases_by_category = db.session.execute(
+        select(DailyPurchases.category, func.sum(DailyPurchases.cost), func.sum(DailyPurchases.units))
+        .where(DailyPurchases.day >= since).group_by(DailyPurchases.category)
+        .order_by(func.sum(DailyPurchases.cost).desc())
+    ).all()
+
+    return render_template('store/analytics.html', days=days, daily=daily, by_category=by_category,
+                           best_sellers=best_sellers, low_stock=low_stock,
+                           purchases_by_category=purchases_by_category,
+                           low_stock_threshold=LOW_STOCK_THRESHOLD)
+
+@app.route('/import', methods=['POST'])
+@login_required('store')
+def import_data():
+    data_type = request.form.get('data_type')
+    upload = request.files.get('file')
+    if data_type not in IMPORT_HEADERS or not upload or not upload.filename:
+        flash('请选择导入类型和 CSV 文件')
+        return redirect(url_for('export'))
+
+    try:
+        lines = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        report = import_csv(data_type, lines)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception(e)
+        flash('导入数据失败')
+        return redirect(url_for('export'))
+
+    return render_template('store/export.html', report=report)
+
+@app.route('/cache_stats')
+@login_required('store')
+def cache_stats_view():
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    return jsonify(backend=CATALOG_CACHE, hit_rate=cache_stats['hits'] / lookups if lookups else None,
+                   **cache_stats)
+
+@app.route('/revoke_sessions', methods=['POST'])
+@login_required('store')
+def revoke_sessions_view():
+    username = (request.form.get('username') or '').strip()
+    customer = Customer.query.filter_by(username=username).first()
+    if customer is None:
+        abort(404)
+    if not revoke_sessions(f'customer:{customer.id}'):
+        return jsonify(error='当前使用 Cookie 会话，无法撤销'), 409
+    return jsonify(revoked=username)
+
 @app.route('/store_logout')
 def store_logout():
-    session.pop('store_logged_in')
+    session.pop('store_logged_in', None)
     return redirect(url_for('store_login'))
 
 # --------------------------------------------------------------------
 
 # ----------------------------顾客视图函数-------------------------------
 @app.route('/customer_register' , methods=['GET','POST'])
+@admission('login', form_key='username')
 def customer_register():
     if request.method == 'POST':
         try:
@@ -458,15 +3786,21 @@ def customer_register():
             flash('注册成功，请登录')
             return redirect(url_for('customer_login'))
 
+        except PasswordHashBusy:
+            db.session.rollback()
+            flash('当前注册人数较多，请稍后再试')
+            return redirect(url_for('customer_register'))
+
         except Exception as e:
             db.session.rollback()
-            print(e)
+            app.logger.exception(e)
             flash('注册失败')
             return redirect(url_for('customer_register'))
 
     return render_template('customer/customer_register.html')
 
 @app.route('/customer_login' , methods=['GET','POST'])
+@admission('login', form_key='username')
 def customer_login():
     if request.method == 'POST':
         try:
@@ -483,16 +3817,24 @@ def customer_login():
                     flash('密码错误')
                     return redirect(url_for('customer_login'))
 
+                if password_needs_rehash(customer.password_hash):
+                    customer.set_password(password)  # 哈希参数调整后，用户登录时顺便升级
+                    db.session.commit()
+
+                rotate_session()
                 session['username'] = username
-                session['customer_logged_in'] = True
+                session['customer_id'] = customer.id
                 flash('登录成功')
                 return redirect(url_for('customer_dashboard'))
 
             flash('账号不存在，请先注册')
             return redirect(url_for('customer_register'))
 
+        except PasswordHashBusy:
+            flash('当前登录人数较多，请稍后再试')
+
         except Exception as e:
-            print(e)
+            app.logger.exception(e)
             flash('登录失败')
 
         return redirect(url_for('customer_login'))
@@ -500,147 +3842,268 @@ def customer_login():
     return render_template('customer/customer_login.html')
 
 @app.route('/customer_dashboard')
+@login_required('customer')
 def customer_dashboard():
-    if not session.get('customer_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('customer_login'))
-
     return render_template('customer/customer_dashboard.html')
 
 @app.route('/customer/module/<name>')
+@login_required('customer')
 def customer_module(name):
-    if not session.get('customer_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('customer_login'))
     allowed_modules = ['product_view','ordering','order_view']
     if name not in allowed_modules:
         abort(404)
     return redirect(url_for(name))
 
 @app.route('/product_view', methods=['GET'])
+@login_required('customer')
+@read_only
 def product_view():
-    if not session.get('customer_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('customer_login'))
-
     pagination = None
     products = []
+    search = request.args.get('search', '', type=str).strip()
 
     try:
-        search = request.args.get('search', '', type=str)
-        page = request.args.get('page', 1, type=int)
-        per_page = 10
-
-        query = Product.query
-        if search:
-            query = query.filter(Product.name.ilike(f'%{search}%'))
-
-        pagination = query.order_by(Product.id).paginate(page=page, per_page=per_page, error_out=False)
+        pagination = catalog_page(search)
         products = pagination.items
 
     except Exception as e:
-        print(e)
+        app.logger.exception(e)
         flash('查询失败')
 
     return render_template('customer/product_view.html',
-                               products=products, pagination=pagination)
+                               products=products, pagination=pagination, search=search)
 
 @app.route('/ordering', methods=['GET','POST'])
+@login_required('customer')
+@admission('checkout')
 def ordering():
-    if not session.get('customer_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('customer_login'))
     if request.method == 'POST':
         try:
             customer = request.form.get('customer')
             phone = request.form.get('phone')
             address = request.form.get('address')
-            product_id = int(request.form.get('product_id'))
-            quantity = int(request.form.get('quantity'))
-            product_choose = Product.query.get(product_id)
+            items = parse_cart(request.form)
 
-            if not customer or not phone or not address or quantity <= 0:
+            if not customer or not phone or not address or not items:
                 flash('请填写完整的有效信息')
                 return redirect(url_for('ordering'))
 
-            if not product_choose :
-                flash('该商品不存在')
-                return redirect(url_for('ordering'))
-
-            if product_choose.stock < quantity:
-                flash('库存不足')
+            if len(items) > CART_MAX_ITEMS:
+                flash(f'每个订单最多包含{CART_MAX_ITEMS}种商品')
                 return redirect(url_for('ordering'))
 
-            # 创建订单
-            new_order = Order(customer=customer, phone=phone, address=address)
-            db.session.add(new_order)
-            db.session.flush() # 获得new_order.id
+            def checkout():
+                create_order(customer, phone, address, items, session['customer_id'])
+                db.session.commit()
 
-            # 创建订单项
-            new_order_item = OrderItem(order_id=new_order.id, product_id=product_id, quantity=quantity)
-            db.session.add(new_order_item)
-            product_choose.stock -= quantity
+            try:
+                run_with_retry(checkout)
+            except OutOfStock:
+                db.session.rollback()
+                flash(describe_shortage(items))
+                return redirect(url_for('ordering'))
+            invalidate_catalog(items)
+            invalidate_orders(customer_id=session['customer_id'])
 
-            db.session.commit()
             flash('订单已提交')
             return redirect(url_for('order_view'))
 
         except Exception as e:
             db.session.rollback()
-            print(e)
+            app.logger.exception(e)
             flash('提交订单失败')
 
     # GET渲染订单提交页面
-    search = request.args.get('search', '', type=str)
-    page = request.args.get('page', 1, type=int)
-    per_page = 10
+    search = request.args.get('search', '', type=str).strip()
 
-    query = Product.query
-    if search:
-        query = query.filter(Product.name.ilike(f'%{search}%'))
-
-    pagination = query.order_by(Product.id).paginate(page=page, per_page=per_page, error_out=False)
+    pagination = catalog_page(search)
     products = pagination.items
-    return render_template('customer/ordering.html',products=products,pagination=pagination)
+    return render_template('customer/ordering.html',products=products,pagination=pagination,search=search)
 
 @app.route('/order_view', methods=['GET'])
+@login_required('customer')
+@read_only
 def order_view():
-    if not session.get('customer_logged_in'):
-        flash('请先登录')
-        return redirect(url_for('customer_login'))
-
     pagination = None
     orders = []
+    search = request.args.get('search', '', type=str).strip()
+    archived = request.args.get('archived') == '1'
 
-    if request.method == 'GET':
-        try:
-            search = request.args.get('search', '', type=str)
-            page = request.args.get('page', 1, type=int)
-            per_page = 10
-
-            query = Order.query.options(joinedload(Order.items).joinedload(OrderItem.product))
-            if search:
-                query = query.join(Order.items).join(OrderItem).filter(Product.name.ilike(f'%{search}%'))
+    try:
+        customer_id = session['customer_id']
+        query, model = order_list_query(archived, search)
+        query = query.filter(model.customer_id == customer_id)
 
-            pagination = query.order_by(Order.id).paginate(page=page, per_page=per_page, error_out=False)
-            orders = pagination.items
+        pagination = keyset_paginate(query, model.id, search, scope=customer_id)
+        orders = pagination.items
 
-        except Exception as e:
-            print(e)
-            flash('查询失败')
+    except Exception as e:
+        app.logger.exception(e)
+        flash('查询失败')
 
     return render_template('customer/order_view.html',
-                               orders=orders, pagination=pagination)
+                               orders=orders, pagination=pagination, search=search, archived=archived)
 
 @app.route('/customer_logout')
 def customer_logout():
-    session.pop('customer_logged_in')
+    session.pop('username', None)
+    session.pop('customer_id', None)
     return redirect(url_for('customer_login'))
 
 # ---------------------------------------------------------------------
 
+# ----------------------------JSON 接口---------------------------------
+# 与 product_view / order_view / order 页面对应的只读接口，供移动端使用
+# 结果连同 ETag 一起放进目录缓存，数据未变时直接按 ETag/Last-Modified 返回 304，不查库也不序列化
+API_PREFIX = '/api/v1'
+API_PER_PAGE = 20
+API_MAX_PER_PAGE = 100
+PRODUCT_FIELDS = ('id', 'name', 'price', 'stock', 'category', 'created_at')
+ORDER_FIELDS = ('id', 'customer', 'phone', 'address', 'status', 'created_at', 'total', 'items')
+
+def api_fields(allowed):
+    """解析 ?fields=id,name，未指定时返回全部字段，含未知字段时返回 None"""
+    raw = request.args.get('fields', '')
+    if not raw:
+        return allowed
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(',') if f.strip()))
+    if not fields or not set(fields) <= set(allowed):
+        return None
+    return fields
+
+def api_bad_fields(allowed):
+    return jsonify(error='fields 只能包含：' + ','.join(allowed)), 400
+
+def api_page(query, column, serialize):
+    """按 ?after=id&limit=n 做游标分页，返回 (数据, 本页的行)"""
+    after = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', API_PER_PAGE, type=int), 1), API_MAX_PER_PAGE)
+    rows = query.filter(column > after).order_by(column).limit(limit + 1).all()
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    payload = {'items': [serialize(row) for row in rows],
+               'next_after': rows[-1].id if has_next else None}
+    return payload, rows
+
+def api_versions(rows, items=False):
+    """本页各行的 [id, version]（带订单项时加上所含商品的 version）和其中最晚的 updated_at"""
+    versions, modified = [], []
+    for row in rows:
+        products = [item.product for item in row.items] if items else []
+        versions.append([row.id, row.version] + [p.version for p in products])
+        modified += [r.updated_at for r in [row] + products if r.updated_at is not None]
+    return versions, max(modified, default=None)
+
+def api_response(key, build):
+    """build() 返回 (数据, 缓存标签, api_versions 的结果)；ETag 由请求参数和各行版本号算出，
+    Last-Modified 取各行 updated_at 的最大值。命中缓存时只比较 ETag，数据失效后才重新查询"""
+    entry = catalog_cache.get(key) if catalog_cache is not None else None
+    if entry is None:
+        if catalog_cache is not None:
+            cache_stats['misses'] += 1
+        payload, tags, (versions, modified) = build()
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=_json_value).encode()
+        # next_after 也算进去：本页之后新增了行，下一页游标会变，本页各行的版本号却不变
+        validator = json.dumps([key, versions, payload['next_after']], separators=(',', ':')).encode()
+        if modified is not None:
+            modified = modified.replace(microsecond=0)
+        entry = (body, hashlib.blake2b(validator, digest_size=16).hexdigest(), modified)
+        if catalog_cache is not None:
+            catalog_cache.set(key, entry, tags)
+    else:
+        cache_stats['hits'] += 1
+
+    body, etag, modified = entry
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    if modified is not None:  # 空页没有行可取时间，只靠 ETag 验证
+        response.last_modified = modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # 客户端每次都带条件头来验证
+    return response.make_conditional(request)
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)  # 两位小数的金额转成 JSON 数字不会丢精度
+    raise TypeError(f'无法序列化 {type(value).__name__}')
+
+def order_json(order, fields):
+    data = {name: getattr(order, name) for name in fields if name != 'items'}
+    if 'items' in fields:
+        data['items'] = [{'product_id': item.product_id, 'name': item.product.name,
+                          'quantity': item.quantity, 'unit_price': item.unit_price}
+                         for item in order.items]
+    return data
+
+def order_query(fields):
+    query = Order.query
+    if 'items' in fields:  # 不要订单项时不做联表
+        query = query.options(joinedload(Order.items).joinedload(OrderItem.product))
+    search = request.args.get('search', '', type=str).strip()
+    if search:
+        query = query.filter(Order.items.any(OrderItem.product.has(product_search_clause(search))))
+    return query
+
+@app.route(API_PREFIX + '/products')
+@login_required('customer')
+@read_only
+def api_products():
+    fields = api_fields(PRODUCT_FIELDS)
+    if fields is None:
+        return api_bad_fields(PRODUCT_FIELDS)
+
+    def build():
+        query = Product.query
+        search = request.args.get('search', '', type=str).strip()
+        if search:
+            query = query.filter(product_search_clause(search))
+        payload, rows = api_page(query, Product.id, lambda p: {name: getattr(p, name) for name in fields})
+        return payload, ['catalog'] + [f'product:{p.id}' for p in rows], api_versions(rows)
+
+    return api_response('api:' + request.full_path, build)
+
+@app.route(API_PREFIX + '/my/orders')
+@login_required('customer')
+@read_only
+def api_my_orders():
+    fields = api_fields(ORDER_FIELDS)
+    if fields is None:
+        return api_bad_fields(ORDER_FIELDS)
+    customer_id = session['customer_id']
+
+    def build():
+        query = order_query(fields).filter(Order.customer_id == customer_id)
+        payload, rows = api_page(query, Order.id, lambda o: order_json(o, fields))
+        return (payload, [f'orders:customer:{customer_id}'] + [f'order:{o.id}' for o in rows],
+                api_versions(rows, 'items' in fields))
+
+    return api_response(f'api:customer:{customer_id}:' + request.full_path, build)
+
+@app.route(API_PREFIX + '/orders')
+@login_required('store')
+@read_only
+def api_orders():
+    fields = api_fields(ORDER_FIELDS)
+    if fields is None:
+        return api_bad_fields(ORDER_FIELDS)
+
+    def build():
+        query = order_query(fields)
+        status = request.args.get('status')
+        if status:
+            query = query.filter(Order.status == status)
+        payload, rows = api_page(query, Order.id, lambda o: order_json(o, fields))
+        return payload, ['orders'] + [f'order:{o.id}' for o in rows], api_versions(rows, 'items' in fields)
+
+    return api_response('api:store:' + request.full_path, build)
+# ---------------------------------------------------------------------
+
 # ----------------------------主程序运行---------------------------------
 if __name__ == '__main__':
+    with app.app_context():
+        run_migrations()
     port = os.environ.get('PORT', 5000)
     app.run(debug=True,port=port)
 # ---------------------------------------------------------------------
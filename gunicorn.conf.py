@@ -0,0 +1,21 @@
+# gunicorn 启动时自动读取本文件（Procfile 里的 gunicorn app:app 不用改）
+# 端口和进程数沿用 gunicorn 对 PORT、WEB_CONCURRENCY 环境变量的默认处理
+import os
+
+# WEB_MODE=sync：同步 worker，一个进程同时只处理一个请求（原来的方式）
+# WEB_MODE=threads：gthread worker，每个进程 WEB_THREADS 个线程，等数据库时其它请求照常处理
+WEB_MODE = os.environ.get('WEB_MODE', 'sync')
+
+if WEB_MODE == 'threads':
+    worker_class = 'gthread'
+    threads = int(os.environ.get('WEB_THREADS', 8))
+    keepalive = 5
+elif WEB_MODE != 'sync':
+    raise RuntimeError(f'WEB_MODE 只能是 sync 或 threads，当前为 {WEB_MODE}')
+
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+
+def post_worker_init(worker):
+    # 定时任务（订单归档、变更记录压缩）的线程在 worker 启动时就开起来，不等第一次提交批量任务
+    from app import start_periodic_jobs
+    start_periodic_jobs()